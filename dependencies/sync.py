@@ -1,19 +1,38 @@
 import asyncio
-from pyppeteer import launch
 import os
 import sys
-import zipfile
 import requests
 import platform
 import json
-from datetime import datetime
-from spire.doc import Document, FileFormat
+import copy
+import itertools
+import time
+import re
+import shutil
+import hashlib
+import base64
+import threading
+import secrets
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs, unquote, quote
+from requests.adapters import HTTPAdapter
+
+# pyppeteer and spire are imported by the code paths that need them, see load_pyppeteer and convert_word
+launch = connect = errors = None
 
 
 DatabasePath = sys.argv[1]
 PluginPath = sys.argv[2]
 selectedCode = sys.argv[3]
 SubjectPrioritization = sys.argv[4]
+# Set for the workers of the server mode: connect to its shared Chromium instead of launching one
+BROWSER_ENDPOINT = sys.argv[sys.argv.index('--browser') + 1] if '--browser' in sys.argv[5:] else None
+# Set for the interval runs of the plugin, only those skip the subjects that are not due yet
+ScheduledRun = '--scheduled' in sys.argv[5:]
 
 #DatabasePath = r"C:\Users\eliac\Documents\Obsidian\Plugins\Database"
 #PluginPath = r"C:\Users\eliac\Documents\Obsidian\Plugins\.obsidian\plugins\Bankai"
@@ -25,6 +44,179 @@ os.makedirs(user_data_dir, exist_ok=True)
     
 chrome_exe = os.path.join(PluginPath,'dependencies', 'chromium', 'chrome-win', 'chrome.exe')
 
+# Cookies exported from browser_data, so sync can talk to SharePoint without a browser
+session_path = os.path.join(PluginPath, 'dependencies', 'session.json')
+# Temp and part files of the download folder that were being written, see stage
+staging_path = os.path.join(PluginPath, 'dependencies', 'staging.json')
+# Login files as they were when renewing the session last failed, see renew_session
+reauth_path = os.path.join(PluginPath, 'dependencies', 'reauth.json')
+# Every cookie of the logged in profile, the Microsoft login ones too. Server workers have no profile,
+# their browser context starts from these so it can log in again.
+login_path = os.path.join(PluginPath, 'dependencies', 'login.json')
+# Numbers of the last run (blocked requests, bytes, page load times, ...)
+stats_path = os.path.join(PluginPath, 'dependencies', 'sync_stats.json')
+# Port and token of the resident sync daemon of this vault, read by main.ts for every command
+daemon_path = os.path.join(PluginPath, 'dependencies', 'daemon.json')
+daemon_token = secrets.token_hex(16)
+# Guid named files Chromium is writing for context menu downloads, the only ones recover_staging removes
+inflight_path = os.path.join(PluginPath, 'dependencies', 'downloads.json')
+inflight_downloads = set()
+# Every downloaded file and converted PDF once, by SHA-256. The vault holds hardlinks into it.
+store_path = os.path.join(PluginPath, 'dependencies', 'store')
+
+# Outputs are written next to their target under these names and renamed into place when complete
+TEMP_SUFFIX = '.bankai-tmp'
+PART_SUFFIX = '.bankai-part'
+
+# Chromium snapshot installed by setup. Its SHA-256 is checked when pinned here, the md5 Google
+# publishes for the object is checked either way. Setup refuses to install when it has neither.
+CHROMIUM_URL = "https://www.googleapis.com/download/storage/v1/b/chromium-browser-snapshots/o/Win_x64%2F1000027%2Fchrome-win.zip?alt=media"
+CHROMIUM_METADATA_URL = "https://www.googleapis.com/storage/v1/b/chromium-browser-snapshots/o/Win_x64%2F1000027%2Fchrome-win.zip"
+CHROMIUM_SHA256 = ''
+
+# Number of pooled connections / parallel REST requests
+HTTP_POOL_SIZE = 8
+# Number of files downloaded at the same time
+DOWNLOAD_CONCURRENCY = 4
+# Number of subjects synced at the same time, each crawler subject gets its own tab
+SUBJECT_CONCURRENCY = 3
+# Number of tabs crawling the folders of one subject
+FOLDER_CONCURRENCY = 1
+# Folders whose modified time and item count did not change are skipped, except for a full run this often
+FULL_VERIFY_HOURS = 24
+# The daemon exits after this long without a command
+DAEMON_IDLE_MINUTES = 30
+# Subjects without changes are synced less often, the interval doubles per unchanged run up to the maximum
+SCHEDULE_BASE_MINUTES = 30
+SCHEDULE_MAX_HOURS = 24
+# Number of change times kept per subject
+SCHEDULE_HISTORY = 10
+# Partial progress of a subject is written to disk at most this often
+CHECKPOINT_INTERVAL_S = 5
+# Up to this many changed items are fetched one by one, more changes fall back to a full listing
+DELTA_MAX_ITEMS = 50
+# Downloads are written in chunks of this size to a .part file, an interrupted one continues with a Range request
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+# Files at least this large are fetched over several connections at once, 1 turns that off
+MULTI_CONNECTIONS = 4
+MULTI_CONNECTION_MIN_BYTES = 64 * 1024 * 1024
+# Shared by all SharePoint requests, downloads and page loads: a token bucket caps the rate, the number in
+# flight grows by one per window without throttling and halves on a 429/503 (AIMD)
+RATE_LIMIT_PER_S = 20
+RATE_BURST = 20
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = HTTP_POOL_SIZE + DOWNLOAD_CONCURRENCY
+# A throttled request is retried this often, waiting for Retry-After or the default
+THROTTLE_RETRIES = 5
+THROTTLE_DEFAULT_S = 10
+# Server mode: one Chromium for many vaults, at most this many sync jobs at once
+SERVER_PORT = 47616
+SERVER_CONCURRENCY = 4
+# Pre-flight check of the saved session before a run
+SESSION_PROBE_TIMEOUT_S = 5
+AUTH_COOKIES = ('FedAuth', 'rtFa')
+
+# Crawler readiness: the list counts as loaded after this much time without DOM changes
+LIST_QUIET_MS = 250
+LIST_TIMEOUT_MS = 15000
+LIST_DATA_TIMEOUT_MS = 5000
+MENU_TIMEOUT_MS = 5000
+# Time the context menu downloads of one folder get to finish
+DOWNLOAD_TIMEOUT_S = 60
+
+# The crawler only needs the list data, everything else the headless pages request can be aborted
+BLOCK_RESOURCES = True
+BLOCKED_RESOURCE_TYPES = {'image', 'media', 'font'}
+BLOCKED_HOSTS = (
+    'browser.events.data.microsoft.com',
+    'js.monitor.azure.com',
+    'c.office.com',
+    'c1.microsoft.com',
+    'events.data.microsoft.com',
+    'clarity.ms',
+)
+CRAWL_VIEWPORT = {'width': 1920, 'height': 1080}
+
+
+class ChromiumDownloadError(Exception):
+    pass
+
+
+def chromium_installed(chromium_dir):
+    # Only a complete install has a manifest, and every file in it has to be there with its size
+    try:
+        with open(os.path.join(chromium_dir, 'install.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    for name, size in manifest['Files'].items():
+        path = os.path.join(chromium_dir, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+def archive_digests(path):
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), base64.b64encode(md5.digest()).decode()
+
+def download_chromium(http, archive_path):
+    # Resumes a partial archive of an earlier setup, starts over once if it does not verify
+    try:
+        expected_md5 = http.get(CHROMIUM_METADATA_URL, timeout=30).json().get('md5Hash')
+    except (requests.RequestException, ValueError):
+        expected_md5 = None
+    if not CHROMIUM_SHA256 and not expected_md5:
+        # Nothing to verify the archive against, never run an unchecked browser
+        raise ChromiumDownloadError(f"No digest to verify {CHROMIUM_URL} against")
+    
+    for attempt in range(2):
+        fetch_range(http, CHROMIUM_URL, archive_path, {'Parts': {}})
+        sha256, md5 = archive_digests(archive_path)
+        if (not CHROMIUM_SHA256 or sha256 == CHROMIUM_SHA256) and (not expected_md5 or md5 == expected_md5):
+            return sha256
+        os.remove(archive_path)
+    raise ChromiumDownloadError(CHROMIUM_URL)
+
+def install_chromium(chromium_dir):
+    # Extracted next to the install and swapped in with a rename, so a failed setup never leaves a half install
+    archive_path = chromium_dir + '.zip' + PART_SUFFIX
+    staging_dir = chromium_dir + '.staging'
+    old_dir = chromium_dir + '.old'
+    
+    sha256 = download_chromium(requests.Session(), archive_path)
+    
+    import zipfile
+    
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    files = {}
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            target = os.path.normpath(os.path.join(staging_dir, member.filename))
+            if not target.startswith(os.path.normpath(staging_dir) + os.sep):
+                continue
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Member by member, reading to the end also checks its CRC
+            with zip_ref.open(member) as source, open(target, 'wb') as f:
+                shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_BYTES)
+            files[member.filename] = member.file_size
+    os.remove(archive_path)
+    
+    with open(os.path.join(staging_dir, 'install.json'), 'w', encoding='utf-8') as f:
+        json.dump({'Url': CHROMIUM_URL, 'Sha256': sha256, 'Files': files}, f, indent=2)
+    
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(chromium_dir):
+        os.replace(chromium_dir, old_dir)
+    os.replace(staging_dir, chromium_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
 
 async def open_sharepoint():  
     # Check and download Chromium if needed (Windows only)
@@ -32,26 +224,13 @@ async def open_sharepoint():
     chrome_path = os.path.join(chromium_dir, 'chrome-win', 'chrome.exe')
     #print(chrome_path)
     
-    if not os.path.exists(chrome_path):
+    if not chromium_installed(chromium_dir):
         #print("Downloading Chromium...")
-        os.makedirs(chromium_dir, exist_ok=True)
-        
-        url = "https://www.googleapis.com/download/storage/v1/b/chromium-browser-snapshots/o/Win_x64%2F1000027%2Fchrome-win.zip?alt=media"
-        
-        # Download and extract
-        zip_path = os.path.join(chromium_dir, 'chromium.zip')
-        response = requests.get(url, stream=True)
-        with open(zip_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(chromium_dir)
-        os.remove(zip_path)
+        await asyncio.to_thread(install_chromium, chromium_dir)
         #print("Chromium downloaded and extracted!")
     
     # Launch browser
+    load_pyppeteer()
     browser = await launch(
         headless=False,
         userDataDir=user_data_dir,
@@ -73,6 +252,7 @@ async def open_sharepoint():
     #print("You got 5 minutes")
     await page.waitForSelector('[data-id="heroField"]', timeout=300000)
     
+    await save_session(page)
     await browser.close()
     
 
@@ -88,8 +268,37 @@ async def open_sharepoint():
 
 
 
+def load_pyppeteer():
+    global launch, connect, errors
+    if launch is None:
+        from pyppeteer import launch, connect, errors
+
+# Cookie fields Network.setCookies accepts out of what save_session exported
+COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'expires', 'httpOnly', 'secure', 'sameSite')
+
+# Browser context of a server worker, its downloads are configured per context
+browser_context_id = None
+
+async def open_context():
+    # An incognito context in the server's Chromium, it only knows the cookies of this vault.
+    # Closing it (browser.close() in the callers) leaves the shared browser running, save_session
+    # keeps what the context logged in with for the next one.
+    global browser_context_id
+    browser = await connect(browserWSEndpoint=BROWSER_ENDPOINT)
+    context = await browser.createIncognitoBrowserContext()
+    browser_context_id = context._id
+    page = await new_page(context)
+    
+    cookies = load_session(login_path) or load_session() or []
+    await page.setCookie(*[{key: c[key] for key in COOKIE_FIELDS if key in c and not (key == 'expires' and c[key] <= 0)}
+                           for c in cookies])
+    return context, page
+
 async def open_browser():
     # Launch in headless mode with saved data
+    load_pyppeteer()
+    if BROWSER_ENDPOINT:
+        return await open_context()
     browser = await launch(
         headless=True,
         userDataDir=user_data_dir,
@@ -101,264 +310,1971 @@ async def open_browser():
         ]
     )
     
-    page = await browser.newPage()
-    await page.setViewport({'width': 1920, 'height': 1080})
+    page = await new_page(browser)
     
     #print("Browser opened.")
     
     return browser, page
 
+def new_stats():
+    return {
+        'Started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'BlockedRequests': {},
+        'BytesLoaded': 0,
+        'PageLoads': 0,
+        'PageLoadMs': 0,
+        'FilesDownloaded': 0,
+        'BytesDownloaded': 0,
+        'Conversions': 0,
+        'ConversionMs': 0,
+        'DuplicateFiles': 0,
+        'ConversionsReused': 0,
+        'ThrottleEvents': 0,
+        'FailedSubjects': [],
+        'ConcurrencyLimit': CONCURRENCY_MAX,
+    }
+
+run_stats = new_stats()
+
+def save_stats():
+    run_stats['Finished'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    run_stats['ConcurrencyLimit'] = concurrency_limit
+    write_json(stats_path, run_stats)
+
+# Renamed into place but not fsynced yet, flushed as one batch on a thread before the JSON that refers to them
+unsynced_files = set()
+
+def flush_files():
+    while unsynced_files:
+        path = unsynced_files.pop()
+        try:
+            # Windows only flushes handles opened for writing
+            with open(path, 'ab') as f:
+                os.fsync(f.fileno())
+        except OSError:
+            pass
+
+# Temp and part files being written in the download folder. Saved with the structure, so recover_staging
+# removes exactly these after a crash instead of walking the vault. One created after the last save is left.
+staged_files = set()
+staging_lock = threading.Lock()
+staging_saved = None
+
+def stage(*paths):
+    with staging_lock:
+        staged_files.update(paths)
+
+def unstage(*paths):
+    with staging_lock:
+        staged_files.difference_update(paths)
+
+def save_staging():
+    global staging_saved
+    with staging_lock:
+        staged = sorted(staged_files)
+    if staged != staging_saved:
+        write_json(staging_path, staged)
+        staging_saved = staged
+
+def write_json(path, data):
+    # The old file stays until the new one is complete on disk, a crash never leaves a truncated JSON
+    temp_path = path + TEMP_SUFFIX
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def save_inflight():
+    write_json(inflight_path, sorted(inflight_downloads))
+
+def recover_staging():
+    # Leftovers of a run that crashed: guid named downloads, temp files and parts no checkpoint continues.
+    # Only paths the manifests recorded, the vault and the plugin folder are never walked.
+    try:
+        with open(inflight_path, 'r', encoding='utf-8') as f:
+            stale_downloads = json.load(f)
+    except (FileNotFoundError, ValueError):
+        stale_downloads = []
+    for path in stale_downloads:
+        # Only files Chromium was writing for a context menu download, never a course file that looks like a guid
+        if os.path.exists(path):
+            os.remove(path)
+    inflight_downloads.clear()
+    if stale_downloads:
+        save_inflight()
+    
+    resumable = set()
+    for subject_name, state in sync_state.items():
+        for key in state.get('Checkpoint', {}).get('Downloads', {}):
+            resumable.add(os.path.normcase(os.path.join(Download_Directory, subject_name, *key.split('/'))))
+    
+    kept = []
+    for path in load_session(staging_path) or []:
+        name = os.path.basename(path)
+        if PART_SUFFIX in name and os.path.normcase(path[:path.rindex(PART_SUFFIX)]) in resumable:
+            kept.append(path)
+        elif (name.endswith(TEMP_SUFFIX) or PART_SUFFIX in name) and os.path.exists(path):
+            os.remove(path)
+    with staging_lock:
+        staged_files.clear()
+        staged_files.update(kept)
+    save_staging()
+    
+    dependencies = os.path.join(PluginPath, 'dependencies')
+    for name in os.listdir(dependencies):
+        if name.endswith(TEMP_SUFFIX):
+            os.remove(os.path.join(dependencies, name))
+
+def count_page_load(started):
+    run_stats['PageLoads'] += 1
+    run_stats['PageLoadMs'] += int((time.monotonic() - started) * 1000)
+
+def count_download(file_path):
+    run_stats['FilesDownloaded'] += 1
+    run_stats['BytesDownloaded'] += os.path.getsize(file_path)
+
+async def intercept(request):
+    host = urlsplit(request.url).hostname or ''
+    if request.resourceType in BLOCKED_RESOURCE_TYPES or host.endswith(BLOCKED_HOSTS):
+        kind = request.resourceType if request.resourceType in BLOCKED_RESOURCE_TYPES else 'analytics'
+        run_stats['BlockedRequests'][kind] = run_stats['BlockedRequests'].get(kind, 0) + 1
+        await request.abort()
+    else:
+        await request.continue_()
+
+def count_bytes(event):
+    run_stats['BytesLoaded'] += int(event.get('encodedDataLength', 0))
+
+# Pages of this process, download events of other server workers' pages are ignored
+own_pages = []
+
+async def new_page(browser):
+    page = await browser.newPage()
+    own_pages.append(page)
+    await page.setViewport(CRAWL_VIEWPORT)
+    
+    page._client.on('Network.loadingFinished', count_bytes)
+    page.on('response', lambda response: collect_list_data(page, response))
+    if BLOCK_RESOURCES:
+        await page.setRequestInterception(True)
+        # pyppeteer turns the cache off with the interception, the SharePoint scripts should come from it
+        await page._client.send('Network.setCacheDisabled', {'cacheDisabled': False})
+        page.on('request', lambda request: asyncio.ensure_future(intercept(request)))
+    return page
+
+async def navigate(page, url):
+    # Page loads count against the rate limiter like the REST requests
+    async def load():
+        response = await page.goto(url)
+        if response is not None and response.status in (429, 503):
+            raise Throttled(retry_after(response.headers))
+        return response
+    return await limited(load)
+
 async def goto_page(page, url):
     
-    await page.goto(url)
+    started = time.monotonic()
+    list_payloads[page] = []
+    try:
+        await navigate(page, url)
+    except Throttled:
+        return False
+    # Redirected to the login page, waiting for the list would only run into the timeout
+    if urlsplit(page.url).netloc != urlsplit(url).netloc:
+        return False
     try:
         await page.waitForSelector('[data-id="heroField"]', timeout=30000)
     except:
         #print("Error: Timeout while waiting for page to load")
-        return
+        return False
+    count_page_load(started)
+    return True
     
     
-async def get_elements(page):
-    for i in range(5):
-        await page.evaluate('var elements = document.querySelectorAll("[data-id=\'heroField\']"); if(elements.length > 0) elements[elements.length - 1].scrollIntoView();')
-        await page.waitFor(300)
+# List data responses of each page since its last navigation, the listing is built from them
+list_payloads = {}
+
+def collect_list_data(page, response):
+    if 'RenderListDataAsStream' in response.url and response.status in (429, 503):
+        # The list view's own requests are not limited, but their throttling slows everything else down
+        throttle(retry_after(response.headers))
+    if 'RenderListDataAsStream' in response.url and response.status == 200:
+        list_payloads.setdefault(page, []).append(asyncio.ensure_future(list_payload(response)))
+
+async def list_payload(response):
+    try:
+        data = await response.json()
+    except (errors.PyppeteerError, ValueError):
+        return None
+    # The list view asks for the schema as well, the rows are under ListData then
+    return data.get('ListData', data) if isinstance(data, dict) else None, response.request
+
+# Fetches the next page of a list data request with the cookies of the page
+NEXT_PAGE_SCRIPT = '''async (url, body, headers) => {
+    const response = await fetch(url, {method: 'POST', body: body, headers: headers, credentials: 'include'});
+    return response.ok ? await response.json() : null;
+}'''
+
+def list_row(row):
+    is_folder = row.get('FSObjType') == '1'
+    size = row.get('File_x0020_Size', '')
+    return {
+        'name': row['FileLeafRef'],
+        'kind': 'folder' if is_folder else 'file',
+        'href': '',
+        'modified': row.get('Modified', ''),
+        'item': library_item(row['FileLeafRef'], row['FileRef'], is_folder, size if str(size).isdigit() else 0,
+                             row.get('Modified', ''), row.get('UniqueId', ''), row.get('_UIVersionString', '')),
+    }
+
+async def harvest_rows(page, folder):
+    # Rows of folder from the intercepted list data, following its paging tokens. None if the page
+    # fetched nothing usable (served from cache), the rendered rows have to be read then.
+    payloads = [payload for payload in await asyncio.gather(*list_payloads.pop(page, [])) if payload and payload[0]]
+    if not payloads:
+        return None
     
-    elements = await page.querySelectorAll('[data-id="heroField"]')
+    rows = {}
+    seen_rows = False
+    for data, request in payloads:
+        next_href = data.get('NextHref')
+        while True:
+            for row in data.get('Row', []):
+                seen_rows = True
+                if 'FileRef' in row and row['FileRef'].rsplit('/', 1)[0].lower() == folder.lower():
+                    rows[row['FileRef']] = list_row(row)
+            if not next_href:
+                break
+            
+            # Same request as the view made, with the paging token in its parameters
+            try:
+                body = json.loads(request.postData or '{}')
+            except ValueError:
+                break
+            body.setdefault('parameters', {})['Paging'] = next_href.lstrip('?')
+            data = await page.evaluate(NEXT_PAGE_SCRIPT, request.url, json.dumps(body), request.headers)
+            if not isinstance(data, dict):
+                break
+            data = data.get('ListData', data)
+            next_href = data.get('NextHref')
     
-    #print(f"Found {len(elements)} elements")
+    if not rows and seen_rows:
+        # Only rows of other folders, not the listing of this one
+        return None
+    return list(rows.values())
+
+# Reads every rendered row of the list in one round trip
+ROWS_SCRIPT = '''() => Array.from(document.querySelectorAll('[data-id="heroField"]'), (el) => {
+    const row = el.closest('[role="row"]');
+    const link = el.closest('a[href]') || el.querySelector('a[href]');
+    const modified = row && row.querySelector('[data-automation-key*="odified"]');
+    return {
+        name: el.textContent.trim(),
+        kind: el.getAttribute('data-selection-invoke') === 'true' ? 'folder' : 'file',
+        href: link ? link.href : '',
+        modified: modified ? modified.textContent.trim() : '',
+    };
+})'''
+
+# Scrolls the virtualized list until scrolling renders no new rows, resolves with the row count
+SETTLE_SCRIPT = '''(quiet, timeout) => new Promise((resolve) => {
+    let last = null;
+    let timer = null;
+    let deadline = null;
+    const finish = () => {
+        observer.disconnect();
+        clearTimeout(timer);
+        clearTimeout(deadline);
+        resolve(document.querySelectorAll('[data-id="heroField"]').length);
+    };
+    const observer = new MutationObserver(() => { clearTimeout(timer); timer = setTimeout(check, quiet); });
+    const check = () => {
+        const elements = document.querySelectorAll('[data-id="heroField"]');
+        const key = elements.length + '|' + (elements.length ? elements[elements.length - 1].textContent : '');
+        if (key === last) {
+            finish();
+            return;
+        }
+        last = key;
+        if (elements.length > 0) elements[elements.length - 1].scrollIntoView();
+        clearTimeout(timer);
+        timer = setTimeout(check, quiet);
+    };
+    // A list that keeps mutating resets the quiet timer forever, this resolves regardless
+    deadline = setTimeout(finish, timeout);
+    observer.observe(document.body, {childList: true, subtree: true});
+    check();
+})'''
+
+MENU_XPATH = "//*[text()='Download' or text()='Herunterladen']"
+
+async def wait_for_rows(page):
+    return await page.evaluate(SETTLE_SCRIPT, LIST_QUIET_MS, LIST_TIMEOUT_MS)
+
+async def wait_for_list_data(page, action):
+    # Runs a navigation and waits for the list data request it triggers to finish
+    started = time.monotonic()
+    list_payloads[page] = []
+    response = asyncio.ensure_future(page.waitForResponse(
+        lambda r: 'RenderListDataAsStream' in r.url, {'timeout': LIST_DATA_TIMEOUT_MS}))
+    await action
+    try:
+        await response
+    except errors.TimeoutError:
+        # Served from cache, get_elements reads the rendered rows then
+        pass
+    count_page_load(started)
+
+async def get_elements(page, folder):
+    rows = await harvest_rows(page, folder)
+    if rows is None:
+        await wait_for_rows(page)
+        rows = await page.evaluate(ROWS_SCRIPT)
     
-    return await assign_elements(page, elements)
+    #print(f"Found {len(rows)} elements")
     
-async def assign_elements(page, elements):
-    Folders = []
-    Files = []
+    return assign_elements(rows)
     
-    for el in elements:
-        attr = await page.evaluate('(el) => el.getAttribute("data-selection-invoke")', el)
-        if attr == "true":
-            Folders.append(el)
-        else:
-            Files.append(el)
+def assign_elements(rows):
+    Folders = [row for row in rows if row['kind'] == 'folder']
+    Files = [row for row in rows if row['kind'] == 'file']
        
     #print(f"Found {len(Folders)} folders and {len(Files)} files")
     
     return Folders, Files
+
+# Finds the heroField of a row, the list is virtualized so a row scrolled out of view is scrolled
+# back in, first upwards then downwards until the edge rows stop changing
+ROW_SCRIPT = '''async (name, quiet) => {
+    const elements = () => Array.from(document.querySelectorAll('[data-id="heroField"]'));
+    const find = () => elements().find((el) => el.textContent.trim() === name) || null;
+    for (const up of [true, false]) {
+        let last = null;
+        while (true) {
+            const found = find();
+            if (found) return found;
+            const rendered = elements();
+            if (rendered.length === 0) return null;
+            const edge = up ? rendered[0] : rendered[rendered.length - 1];
+            if (edge.textContent === last) break;
+            last = edge.textContent;
+            edge.scrollIntoView({block: up ? 'end' : 'start'});
+            await new Promise((resolve) => setTimeout(resolve, quiet));
+        }
+    }
+    return null;
+}'''
+
+async def row_handle(page, row):
+    # Only rows that get clicked are resolved to an element handle
+    handle = await page.evaluateHandle(ROW_SCRIPT, row['name'], LIST_QUIET_MS)
+    return handle.asElement()
     
 
-async def download_files(page, Files):
-    # Create folder structure in downloads
-    folder_path = os.path.join(Download_Directory, *current_path) if current_path else Download_Directory
-    os.makedirs(folder_path, exist_ok=True)
+def convert_word(folder_path, file_name):
+    # Returns the name of the generated PDF, None for non Word files or failed conversions
+    if not (file_name.endswith('.docx') or file_name.endswith('.doc')):
+        return None
+    
+    doc_name = file_name.rsplit('.', 1)[0] + '.pdf'
+    # Spire writes a temp file, the PDF only appears once it is complete
+    temp_path = os.path.join(folder_path, doc_name + TEMP_SUFFIX)
+    stage(temp_path)
+    try:
+        # Loads the native Spire libraries, only runs that convert something pay for that
+        from spire.doc import Document, FileFormat
+        doc = Document()
+        doc.LoadFromFile(os.path.join(folder_path, file_name))
+        doc.SaveToFile(temp_path, FileFormat.PDF)
+        doc.Close()
+        os.replace(temp_path, os.path.join(folder_path, doc_name))
+    except Exception as e:
+        #print(f"Failed to convert {file_name}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    finally:
+        unstage(temp_path)
+    unsynced_files.add(os.path.join(folder_path, doc_name))
+    
+    #print(f"Converted {file_name} to {doc_name}")
+    return doc_name
+
+# Context menu downloads by CDP guid: name, folder, received bytes, final path and a done future
+ui_downloads = {}
+ui_download_queue = asyncio.Queue()
+ui_download_folder = None
+ui_download_lock = asyncio.Lock()
+browser_connection = None
+
+def track_downloads(browser):
+    global browser_connection
+    # A server worker gets its browser context here, the connection belongs to the browser
+    browser_connection = getattr(browser, '_browser', browser)._connection
+    
+    def will_begin(event):
+        if not any(frame._id == event.get('frameId') for page in own_pages for frame in page.frames):
+            return
+        # Recorded before Chromium writes anything, so recover_staging can remove it after a crash
+        inflight_downloads.add(os.path.join(ui_download_folder, event['guid']))
+        save_inflight()
+        ui_downloads[event['guid']] = {
+            'name': event['suggestedFilename'],
+            'folder': ui_download_folder,
+            'bytes': 0,
+            'path': None,
+            'done': asyncio.get_event_loop().create_future(),
+        }
+        ui_download_queue.put_nowait(event['guid'])
+    
+    def progress(event):
+        download = ui_downloads.get(event['guid'])
+        if download is None or download['done'].done():
+            return
+        download['bytes'] = event['receivedBytes']
+        if event['state'] == 'completed':
+            download['path'] = os.path.join(download['folder'], download['name'])
+            os.replace(os.path.join(download['folder'], event['guid']), download['path'])
+            download['done'].set_result(download)
+        elif event['state'] == 'canceled':
+            download['done'].set_result(None)
+        else:
+            return
+        inflight_downloads.discard(os.path.join(download['folder'], event['guid']))
+        save_inflight()
+    
+    browser_connection.on('Browser.downloadWillBegin', will_begin)
+    browser_connection.on('Browser.downloadProgress', progress)
+
+async def download_direct(page, folder, folder_path, Files, existing_file_data, checkpoint, folders):
+    # Downloads the files of the open folder in parallel with the cookies of the page, returns the failed ones
+    if crawl_http is None or not Files:
+        return Files
+    
+    site_url = split_library(page.url)[0]
+    
+    async def fetch(row):
+        try:
+            item = row.get('item')
+            return await fetch_and_convert(crawl_http, site_url, item['url'] if item else folder + '/' + row['name'],
+                                           folder_path, row['name'], existing_file_data, item, checkpoint, folders)
+        except SessionExpired:
+            return False
     
-    await page._client.send('Page.setDownloadBehavior', {
-        'behavior': 'allow',
-        'downloadPath': os.path.abspath(folder_path)
-    })
+    results = await asyncio.gather(*(fetch(row) for row in Files))
+    return [row for row, done in zip(Files, results) if not done]
+
+async def cancel_download(guid):
+    params = {'guid': guid}
+    if browser_context_id:
+        params['browserContextId'] = browser_context_id
+    try:
+        await browser_connection.send('Browser.cancelDownload', params)
+    except errors.PyppeteerError:
+        pass
 
-    downloads_started = 0
-    downloaded_files = []
+async def wait_for_download(name):
+    # The guid of the download the click on name started, None if none began in time.
+    # Downloads of earlier clicks that began late are canceled, they would land in the wrong folder.
+    deadline = time.monotonic() + MENU_TIMEOUT_MS / 1000
+    while True:
+        try:
+            guid = await asyncio.wait_for(ui_download_queue.get(), max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return None
+        if ui_downloads[guid]['name'] == name:
+            return guid
+        await cancel_download(guid)
+
+async def download_files_ui(page, Files, folder_path, existing_file_data, checkpoint, folders):
+    # Fallback through the context menu of each row
+    global ui_download_folder
+    
+    downloads_started = []
+    
+    # Downloads are saved under their guid and renamed once complete, see track_downloads
+    ui_download_folder = os.path.abspath(folder_path)
+    behavior = {
+        'behavior': 'allowAndName',
+        'downloadPath': ui_download_folder,
+        'eventsEnabled': True
+    }
+    if browser_context_id:
+        behavior['browserContextId'] = browser_context_id
+    await browser_connection.send('Browser.setDownloadBehavior', behavior)
+    
+    # The rows are only scrolled into the DOM when the context menu is needed
+    await wait_for_rows(page)
+    items = {row['name']: row.get('item') for row in Files}
+    
+    # Start downloads
+    for row in Files:
+        el = await row_handle(page, row)
+        if el is None:
+            continue
+        await el.executionContext.evaluate('element => element.scrollIntoViewIfNeeded()', el)
+        while not ui_download_queue.empty():
+            await cancel_download(ui_download_queue.get_nowait())
+        await el.click({'button': 'right'})
+        try:
+            download_button = await page.waitForXPath(MENU_XPATH, {'visible': True, 'timeout': MENU_TIMEOUT_MS})
+        except errors.TimeoutError:
+            download_button = None
+        
+        if download_button:
+            await download_button.click()
+            guid = await wait_for_download(row['name'])
+            if guid is not None:
+                downloads_started.append(ui_downloads[guid]['done'])
+            try:
+                await page.waitForXPath(MENU_XPATH, {'hidden': True, 'timeout': MENU_TIMEOUT_MS})
+            except errors.TimeoutError:
+                pass
+
+    # Convert each download the moment it completes
+    try:
+        for done in asyncio.as_completed(downloads_started, timeout=DOWNLOAD_TIMEOUT_S):
+            download = await done
+            if download is None:
+                continue
+            count_download(download['path'])
+            unsynced_files.add(download['path'])
+            file_hash = await asyncio.to_thread(store_file, download['path'])
+            existing_file_data[download['name']] = file_entry(items.get(download['name']), file_hash)
+            await convert_file(folder_path, download['name'], existing_file_data, checkpoint,
+                               '/'.join([*folders, download['name']]), file_hash)
+    except asyncio.TimeoutError:
+        #print("Timeout Error while Downloading. Rest of Files will be Downloaded next Time")
+        pass
+    
+    #print(f"All {len(downloads_started)} downloads completed!")
+
+async def download_files(page, Files, current_dict, path, folder, checkpoint):
+    # Create folder structure in downloads
+    folder_path = os.path.join(Download_Directory, *path)
+    os.makedirs(folder_path, exist_ok=True)
     
     # Check existing files in database
-    current_dict = structure
-    for folder in current_path:
-        if folder not in current_dict:
-            current_dict[folder] = {}
-        current_dict = current_dict[folder]
     existing_file_data = current_dict.get('__FileData__', {})
     
+    # Skip if already downloaded and unchanged, same check as diff_library when the list data has the item
+    def needs_download(row):
+        entry = existing_file_data.get(row['name'])
+        item = row.get('item')
+        if entry is None:
+            return True
+        if item is None:
+            # Row without list data, only the name to go by
+            return False
+        if isinstance(entry, str):
+            # Entry of an older version with only the download date, take it as unchanged
+            existing_file_data[row['name']] = dict(file_entry(item), Date=entry)
+            return False
+        return file_changed(entry, item)
+    
+    Files = [row for row in Files if needs_download(row)]
+    # A changed file keeps its old entry until the new download replaces it
+    previous = {row['name']: existing_file_data.get(row['name']) for row in Files}
+    
+    # Fetch the files directly, the context menu is only used for the ones that failed
+    Files = await download_direct(page, folder, folder_path, Files, existing_file_data, checkpoint, path[1:])
+    
     if Files:
-        # Start downloads
-        for el in Files:
-            file_name = await page.evaluate('(e) => e.textContent.trim()', el)
-            
-            # Skip if already downloaded
-            if file_name in existing_file_data:
-                #print(f"Skipping {file_name} - already downloaded")
-                continue
-            
-            await el.executionContext.evaluate('element => element.scrollIntoViewIfNeeded()', el)
-            await el.click({'button': 'right'})
-            await page.waitFor(300)
-            download_button = await page.xpath("//*[text()='Download' or text()='Herunterladen']")
-            
-            if download_button:
-                download_button = download_button[0]
-                await download_button.click()
-                downloads_started += 1
-                downloaded_files.append(file_name)
-                existing_file_data[file_name] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                await page.waitFor(100)
-
-        # Monitor downloads and convert as they complete
-        if downloads_started > 0:
-            converted_files = set()
-            for _ in range(60):
-                entries = os.listdir(folder_path)
-                in_progress = [f for f in entries if f.endswith('.crdownload')]
-                completed = [f for f in entries if not f.endswith('.crdownload')]
-                
-                # Convert completed Word docs immediately
-                for file_name in downloaded_files:
-                    if file_name in completed and file_name not in converted_files:
-                        if file_name.endswith('.docx') or file_name.endswith('.doc'):
-                            doc_name = file_name.rsplit('.', 1)[0] + '.pdf'
-                            file_path = os.path.join(folder_path, file_name)
-                            doc_path = os.path.join(folder_path, doc_name)
-                            
-                            try:
-                                doc = Document()
-                                doc.LoadFromFile(file_path)
-                                doc.SaveToFile(doc_path, FileFormat.PDF)
-                                doc.Close()
-                                existing_file_data[doc_name] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                                #print(f"Converted {file_name} to {doc_name}")
-                                converted_files.add(file_name)
-                            except Exception as e:
-                                #print(f"Failed to convert {file_name}: {e}")
-                                pass
-                
-                # Check if all downloads complete
-                if len(completed) >= downloads_started and not in_progress:
-                    break
-                await asyncio.sleep(1)
-            else:
-                #print("Timeout Error while Downloading. Rest of Files will be Downloaded next Time")
-                pass
+        # Only one folder at a time can use the browser wide download behavior
+        async with ui_download_lock:
+            await download_files_ui(page, Files, folder_path, existing_file_data, checkpoint, path[1:])
     
     # Update files in structure
     current_dict['__FileData__'] = existing_file_data
     
-    #print(f"All {downloads_started} downloads completed!")
-    return
+    # False if some files are still missing or not updated
+    return all(existing_file_data.get(name) is not None and existing_file_data.get(name) is not entry
+               for name, entry in previous.items())
 
-async def update_database(page):
-    Folders, Files = await get_elements(page)
-    await download_files(page, Files)
+async def update_database(browser, page, node, state, subject_name, url, force=False):
+    # Visits every changed folder of the subject exactly once through its ?id= url, lowest priority first.
+    # The priority is the depth, so the queue is drained breadth-first.
+    # The queued folders are checkpointed, so an interrupted crawl continues with them.
+    site_url, library, root_folder = split_library(url)
+    view_url = url.split('?')[0]
+    queue = asyncio.PriorityQueue()
+    visited = {root_folder}
+    pushed = itertools.count()
+    checkpoint = state['Checkpoint']
+    frontier = checkpoint['Frontier']
     
-    if Folders:
-        for i in range(len(Folders)):
-            el = Folders[i]
-            # Get folder name
-            folder_name = await page.evaluate('(e) => e.textContent.trim()', el)
-            
+    def enqueue(priority, folder, path, info):
+        visited.add(folder)
+        frontier[folder] = [priority, path, info]
+        queue.put_nowait((priority, next(pushed), folder, path, info))
+    
+    async def visit(page, priority, folder, path, info=None):
+        Folders, Files = await get_elements(page, folder)
+        current_dict = folder_node(node, path[1:])
+        if await download_files(page, Files, current_dict, path, folder, checkpoint):
+            if info:
+                current_dict['__FolderData__'] = info
+        else:
+            forget_folder_data(node, path[1:])
+        
+        children = [row for row in Folders if folder + '/' + row['name'] not in visited]
+        infos = await asyncio.gather(*(folder_info(crawl_http, site_url, folder + '/' + row['name']) for row in children))
+        for row, child_info in zip(children, infos):
             # Add folder to structure if it doesn't exist
-            current_dict = structure
-            for folder in current_path:
-                current_dict = current_dict[folder]
-            if folder_name not in current_dict:
-                current_dict[folder_name] = {}
-            
-            # Navigate into folder
-            current_path.append(folder_name)
-            await el.executionContext.evaluate('element => element.scrollIntoViewIfNeeded()', el)
-            await el.click()
-            await page.waitFor(500)
-            await update_database(page)
+            child_dict = current_dict.setdefault(row['name'], {})
+            child = folder + '/' + row['name']
+            visited.add(child)
             
-            # Go back
-            current_path.pop()
-            refreshed_Folders, _ = await get_elements(page)
-            if len(refreshed_Folders) >= len(Folders):
-                Folders = refreshed_Folders
-            else:
-                #print("Danger someone deleted a Folder mid Sync")
-                pass
-        
-        await page.waitFor(500)
-        await page.goBack()
+            # Unchanged since the last run, skip the whole subtree
+            if not force and child_info is not None and child_dict.get('__FolderData__') == child_info:
+                continue
+            enqueue(priority + 1, child, path + [row['name']], child_info)
+    
+    async def worker(page):
+        while True:
+            priority, _, folder, path, info = await queue.get()
+            try:
+                await wait_for_list_data(page, navigate(page, f"{view_url}?id={quote(folder, safe='')}"))
+                await visit(page, priority, folder, path, info)
+            except (errors.PyppeteerError, Throttled):
+                # Rest of the folder will be synced next time
+                forget_folder_data(node, path[1:])
+            except Exception as e:
+                # Skip only this folder, a dead worker would leave queue.join() waiting forever
+                #print(f"Error in folder {folder}: {e}")
+                forget_folder_data(node, path[1:])
+            finally:
+                frontier.pop(folder, None)
+                try:
+                    await save_checkpoint(subject_name, node, state)
+                except OSError as e:
+                    # The next checkpoint writes it
+                    #print(f"Could not save checkpoint: {e}")
+                    pass
+                finally:
+                    queue.task_done()
+    
+    if frontier:
+        # Resume where the last run stopped
+        for folder, (priority, path, info) in list(frontier.items()):
+            enqueue(priority, folder, path, info)
     else:
-        await page.waitFor(500)
-        await page.goBack()
+        # The subject page itself is already open
+        await visit(page, 0, root_folder, [subject_name])
+        await save_checkpoint(subject_name, node, state)
+    
+    tabs = [page] + [await new_page(browser) for _ in range(FOLDER_CONCURRENCY - 1)]
+    workers = [asyncio.ensure_future(worker(tab)) for tab in tabs]
+    await queue.join()
+    for w in workers:
+        w.cancel()
+    for tab in tabs[1:]:
+        await tab.close()
     return
 
 
+# Pooled HTTP session with the cookies of the crawler page, used for direct downloads
+crawl_http = None
+
+def selected_subjects():
+    if SubjectPrioritization == "" and ScheduledRun:
+        # Interval runs only sync the subjects that are due
+        return [(subject, url) for subject, url in zip(Subjects, pages) if subject_due(sync_state.get(subject, {}))]
+    if SubjectPrioritization == "":
+        return list(zip(Subjects, pages))
+    return [(subject, url) for subject, url in zip(Subjects, pages) if subject == SubjectPrioritization]
+
+def save_structure():
+    # Update sync time and save structure to JSON
+    structure["SyncTime"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    write_json(dataPath, structure)
+
+def save_state():
+    write_json(statePath, sync_state)
+
+async def merge_subject(subject_name, node):
+    # Workers sync into their own copy of the subject, merged and saved without awaiting in between.
+    # The files it refers to are fsynced first, in one batch off the event loop.
+    while unsynced_files:
+        await asyncio.to_thread(flush_files)
+    structure[subject_name] = node
+    save_structure()
+    save_state()
+    save_staging()
+
+
+async def crawl_subject(browser, tabs, subject_name, url):
+    global crawl_http
+    
+    # Returns 'reauth required' when the subject page sent it to the login page
+    page = await tabs.get()
+    node = None
+    try:
+        if not await goto_page(page, url):
+            # Tried again next run
+            run_stats['FailedSubjects'].append(subject_name)
+            if urlsplit(page.url).netloc != urlsplit(url).netloc:
+                return 'reauth required'
+            return None
+        if crawl_http is None:
+            crawl_http = open_http_session(await save_session(page))
+        
+        started = datetime.now()
+        node = copy.deepcopy(structure.get(subject_name, {}))
+        before = copy.deepcopy(node)
+        state = sync_state.setdefault(subject_name, {})
+        force = full_verify_due(state)
+        await resume_subject(crawl_http, node, state, subject_name)
+        await update_database(browser, page, node, state, subject_name, url, force)
+        if force:
+            state['FullVerify'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        state.pop('Checkpoint', None)
+        schedule_subject(state, node != before, started)
+        await merge_subject(subject_name, node)
+    except Exception as e:
+        # Only this subject fails, like a REST sync worker, its checkpoint continues it next run
+        #print(f"Crawl of {subject_name} failed: {e}")
+        run_stats['FailedSubjects'].append(subject_name)
+        if node is not None:
+            await save_checkpoint(subject_name, node, state, force=True)
+    finally:
+        tabs.put_nowait(page)
+    return None
+
 async def main():
     
-    browser, page = await open_browser()
+    subjects = selected_subjects()
+    if not subjects:
+        save_stats()
+        return 'ok'
     
-    if SubjectPrioritization == "":
+    # The cookies the last crawl exported, the browser profile expires together with them
+    cookies = load_session()
+    if cookies is not None:
+        status = await check_session(cookies, subjects[0][1])
+        if status != 'ok':
+            report_status(status)
+            return status
     
-        for i in range(len(pages)):
-            subject_name = Subjects[i]
-            
-            # Initialize subject in structure
-            if subject_name not in structure:
-                structure[subject_name] = {}
-            
-            # Set current path to subject
-            current_path.clear()
-            current_path.append(subject_name)
-            
-            await goto_page(page, pages[i])
-            await update_database(page)
-            
-            # Clear path after processing subject
-            current_path.clear()
-            
-            # Update sync time and save structure to JSON after each subject
-            structure["SyncTime"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            with open(dataPath, 'w', encoding='utf-8') as f:
-                json.dump(structure, f, indent=2, ensure_ascii=False)
-    else:
-        subject_name = SubjectPrioritization
-        
-                    # Initialize subject in structure
-        if subject_name not in structure:
-            structure[subject_name] = {}
-        
-        # Set current path to subject
-        current_path.clear()
-        current_path.append(subject_name)
-        
-        for i in range(len(Subjects)):
-            if Subjects[i] == subject_name:
-                n = i
+    browser, page = await open_browser()
+    try:
+        track_downloads(browser)
         
-        await goto_page(page, pages[n])
-        await update_database(page)
+        tabs = asyncio.Queue()
+        tabs.put_nowait(page)
+        for _ in range(min(SUBJECT_CONCURRENCY, len(subjects)) - 1):
+            tabs.put_nowait(await new_page(browser))
         
-        # Clear path after processing subject
-        current_path.clear()
+        results = await asyncio.gather(*(crawl_subject(browser, tabs, subject_name, url) for subject_name, url in subjects),
+                                       return_exceptions=True)
+    finally:
+        # A headless Chromium left running would outlive the sync
+        await browser.close()
+    
+    for (subject_name, url), result in zip(subjects, results):
+        if isinstance(result, Exception) and subject_name not in run_stats['FailedSubjects']:
+            run_stats['FailedSubjects'].append(subject_name)
+    #print("Database structure saved to database.json")
+    await asyncio.to_thread(prune_store)
+    status = 'reauth required' if 'reauth required' in results else 'ok'
+    report_status(status)
+    return status
+
+
+
+class SessionExpired(Exception):
+    pass
+
+class Throttled(requests.RequestException):
+    # SharePoint answered 429/503, retry_after in seconds
+    def __init__(self, retry_after, response=None):
+        super().__init__(f"Throttled for {retry_after:.0f} s", response=response)
+        self.retry_after = retry_after
+
+def retry_after(headers):
+    # Retry-After is either seconds or an HTTP date, the crawler's response headers are lower case
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return THROTTLE_DEFAULT_S
+
+def raise_if_throttled(response):
+    if response.status_code in (429, 503):
+        raise Throttled(retry_after(response.headers), response=response)
+
+# Rate limiter state, kept by the daemon across runs
+concurrency_limit = CONCURRENCY_MAX
+in_flight = 0
+rate_tokens = RATE_BURST
+rate_updated = time.monotonic()
+throttled_until = 0
+success_streak = 0
+limiter_changed = asyncio.Event()
+
+async def acquire_request():
+    global rate_tokens, rate_updated, in_flight
+    while True:
+        now = time.monotonic()
+        rate_tokens = min(RATE_BURST, rate_tokens + (now - rate_updated) * RATE_LIMIT_PER_S)
+        rate_updated = now
+        if now >= throttled_until and in_flight < concurrency_limit and rate_tokens >= 1:
+            rate_tokens -= 1
+            in_flight += 1
+            return
         
-        # Update sync time and save structure to JSON after each subject
-        structure["SyncTime"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open(dataPath, 'w', encoding='utf-8') as f:
-            json.dump(structure, f, indent=2, ensure_ascii=False)
+        if now < throttled_until:
+            timeout = throttled_until - now
+        elif rate_tokens < 1:
+            timeout = (1 - rate_tokens) / RATE_LIMIT_PER_S
+        else:
+            # Waits for a request to finish
+            timeout = None
+        limiter_changed.clear()
+        try:
+            await asyncio.wait_for(limiter_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def throttle(seconds):
+    global throttled_until, concurrency_limit, success_streak
+    now = time.monotonic()
+    run_stats['ThrottleEvents'] += 1
+    # The other answers of the same burst do not halve the limit again
+    if now >= throttled_until:
+        concurrency_limit = max(CONCURRENCY_MIN, concurrency_limit // 2)
+    throttled_until = max(throttled_until, now + seconds)
+    success_streak = 0
+    limiter_changed.set()
+
+def release_request(throttled_for=None):
+    global in_flight, concurrency_limit, success_streak
+    in_flight -= 1
+    if throttled_for is not None:
+        throttle(throttled_for)
+    else:
+        success_streak += 1
+        if success_streak >= concurrency_limit and concurrency_limit < CONCURRENCY_MAX:
+            concurrency_limit += 1
+            success_streak = 0
+    limiter_changed.set()
+
+async def limited(request):
+    # Runs request() under the rate limiter, a Throttled one is retried after its Retry-After
+    for attempt in range(THROTTLE_RETRIES):
+        await acquire_request()
+        try:
+            result = await request()
+        except Throttled as e:
+            release_request(e.retry_after)
+            if attempt == THROTTLE_RETRIES - 1:
+                raise
+            continue
+        except BaseException:
+            release_request()
+            raise
+        release_request()
+        return result
+
+# Limits the number of requests running on the pooled session at once
+http_slots = asyncio.Semaphore(HTTP_POOL_SIZE)
+download_slots = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+convert_lock = asyncio.Lock()
+# Form digest and its expiry time per site, needed for POST requests
+form_digests = {}
+
+# Whole library in one paged query, files and folders of every depth
+LIBRARY_VIEW_XML = (
+    "<View Scope='RecursiveAll'><ViewFields>"
+    "<FieldRef Name='FileRef'/><FieldRef Name='FSObjType'/><FieldRef Name='File_x0020_Size'/>"
+    "<FieldRef Name='Modified'/><FieldRef Name='UniqueId'/><FieldRef Name='_UIVersionString'/>"
+    "</ViewFields><RowLimit Paged='TRUE'>5000</RowLimit></View>"
+)
+
+
+async def save_session(page):
+    # Export the SharePoint cookies of the logged in profile
+    cookies = (await page._client.send('Network.getAllCookies'))['cookies']
+    write_json(login_path, cookies)
+    cookies = [c for c in cookies if 'sharepoint.com' in c['domain']]
+    write_json(session_path, cookies)
+    return cookies
+
+def cookies_expired(cookies):
+    # Expiry in epoch seconds, -1 for session cookies whose validity only a request can tell
+    auth = [c for c in cookies if c['name'] in AUTH_COOKIES]
+    return not auth or all(0 < c.get('expires', -1) < time.time() for c in auth)
+
+def probe_session(http, site_url):
+    try:
+        response = http.get(site_url + '/_api/web?$select=Title', allow_redirects=False, timeout=SESSION_PROBE_TIMEOUT_S)
+    except requests.RequestException:
+        return 'offline'
+    if response.status_code in (301, 302, 401, 403):
+        return 'reauth required'
+    return 'ok'
+
+async def check_session(cookies, url):
+    # One request instead of a page load timeout per subject: 'ok', 'reauth required' or 'offline'
+    if not cookies or cookies_expired(cookies):
+        return 'reauth required'
+    http = requests.Session()
+    for c in cookies:
+        http.cookies.set(c['name'], c['value'], domain=c['domain'], path=c.get('path', '/'))
+    return await asyncio.to_thread(probe_session, http, split_library(url)[0])
+
+def report_status(status):
+    # Read by the plugin from the daemon reply, direct runs print it
+    run_stats['Status'] = status
+    save_stats()
+
+def load_session(path=session_path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def login_stamp():
+    # Changes when setup saves a new session or the browser profile is reset
+    stamp = []
+    for path in (session_path, user_data_dir):
+        try:
+            stamp.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+async def renew_session():
+    # The only time sync starts Chromium: let the saved profile log in again.
+    # After a failed renewal runs report reauth required right away until setup ran again.
+    if load_session(reauth_path) == login_stamp():
+        return None
+    
+    browser, page = await open_browser()
+    try:
+        if not await goto_page(page, pages[0]):
+            # The saved Microsoft login signs in by itself and redirects back to the library
+            try:
+                await page.waitForFunction(f"location.host === {json.dumps(urlsplit(pages[0]).netloc)}", timeout=30000)
+                await page.waitForSelector('[data-id="heroField"]', timeout=30000)
+            except errors.PyppeteerError:
+                pass
+        renewed = await page.querySelector('[data-id="heroField"]') is not None
+        cookies = await save_session(page) if renewed else None
+    finally:
+        await browser.close()
+    
+    if cookies is None:
+        #print("Session could not be renewed, run setup again")
+        # Taken after Chromium closed, it touches the profile folder itself
+        write_json(reauth_path, login_stamp())
+    return cookies
+
+def open_http_session(cookies):
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE + DOWNLOAD_CONCURRENCY * MULTI_CONNECTIONS)
+    http.mount('https://', adapter)
+    http.headers['Accept'] = 'application/json;odata=nometadata'
+    for c in cookies:
+        http.cookies.set(c['name'], c['value'], domain=c['domain'], path=c.get('path', '/'))
+    form_digests.clear()
+    return http
+
+
+def check_response(response, url):
+    # SharePoint redirects to the login page or answers 401/403 once the cookies are expired
+    if response.status_code in (301, 302, 401, 403):
+        raise SessionExpired(url)
+    response.raise_for_status()
+    return response
+
+async def rest_request(http, method, url, **kwargs):
+    async def send():
+        async with http_slots:
+            response = await asyncio.to_thread(http.request, method, url, allow_redirects=False, timeout=30, **kwargs)
+        raise_if_throttled(response)
+        return response
+    
+    try:
+        response = await limited(send)
+    except Throttled as e:
+        # Still throttled after the retries, fails like any other error answer
+        response = e.response
+    return check_response(response, url)
+
+async def rest_get(http, url):
+    return await rest_request(http, 'GET', url)
+
+async def rest_post(http, site_url, url, body):
+    # Digests expire after about 30 minutes, which matters for the long running daemon
+    if site_url not in form_digests or form_digests[site_url][1] < time.monotonic():
+        info = (await rest_request(http, 'POST', site_url + '/_api/contextinfo')).json()
+        form_digests[site_url] = (info['FormDigestValue'], time.monotonic() + info['FormDigestTimeoutSeconds'] - 60)
+    headers = {'X-RequestDigest': form_digests[site_url][0], 'Content-Type': 'application/json;odata=nometadata'}
+    return await rest_request(http, 'POST', url, data=json.dumps(body), headers=headers)
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def fetch_range(http, url, part_path, download, start=0, end=None, size=None):
+    # Continues part_path from where it stopped, end=None means up to the end of the file.
+    # A segment (end set) of a file that no longer has the given size raises RangeNotSupported.
+    part_name = os.path.basename(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if end is not None and start + offset > end:
+        return
+    
+    headers = {}
+    if start + offset > 0 or end is not None:
+        headers['Range'] = f"bytes={start + offset}-{'' if end is None else end}"
+        # The server sends the whole file instead if it changed since the partial download started
+        if download.get('Validator'):
+            headers['If-Range'] = download['Validator']
+    
+    with http.get(url, stream=True, allow_redirects=False, timeout=60, headers=headers) as response:
+        stale = response.status_code == 416 and end is None
+        if stale:
+            # Partial file is already complete, unless the file on the server no longer has its size
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == start + offset:
+                return
+        else:
+            raise_if_throttled(response)
+            check_response(response, url)
+            if response.status_code != 206:
+                if end is not None:
+                    raise RangeNotSupported(url)
+                offset = 0
+            elif end is not None and size is not None:
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                if total.isdigit() and int(total) != size:
+                    raise RangeNotSupported(url)
+            if end is None:
+                # Segments run in threads and share the validator fetch_segments set before they started
+                download['Validator'] = response.headers.get('ETag') or response.headers.get('Last-Modified')
             
-    #print("Database structure saved to database.json")
-    await browser.close() 
+            parts = download['Parts']
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    parts[part_name] = offset
+    
+    if stale:
+        # The part belongs to another version of the file, download it again from the start
+        os.remove(part_path)
+        download['Parts'][part_name] = 0
+        download['Validator'] = None
+        fetch_range(http, url, part_path, download, start, end)
+
 
+def track_parts(download, part_paths):
+    # The checkpoint can be written while a download runs, so the dict is replaced once instead of growing
+    download['Parts'] = {os.path.basename(part_path): os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                         for part_path in part_paths}
+
+
+def fetch_segments(http, url, file_path, download, size):
+    step = -(-size // MULTI_CONNECTIONS)
+    segments = [(f"{file_path}{PART_SUFFIX}{i}", start, min(start + step, size) - 1) for i, start in enumerate(range(0, size, step))]
+    track_parts(download, [part_path for part_path, start, end in segments])
+    if not download.get('Validator'):
+        # Set once before the threads start, the segments only read it
+        with http.head(url, allow_redirects=False, timeout=60) as response:
+            raise_if_throttled(response)
+            check_response(response, url)
+            length = response.headers.get('Content-Length', '')
+            if length.isdigit() and int(length) != size:
+                # The file changed since it was listed, split by a stale size it would be cut off
+                raise RangeNotSupported(url)
+            download['Validator'] = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    with ThreadPoolExecutor(len(segments)) as pool:
+        list(pool.map(lambda segment: fetch_range(http, url, segment[0], download, segment[1], segment[2], size), segments))
     
+    with open(file_path + PART_SUFFIX, 'wb') as out:
+        for part_path, start, end in segments:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, out, DOWNLOAD_CHUNK_BYTES)
+    for part_path, start, end in segments:
+        os.remove(part_path)
 
-if __name__ == "__main__":
-    if selectedCode == "sync":
-        
-        dataPath = os.path.join(PluginPath, 'dependencies', 'database.json')
-        subjectPath = os.path.join(PluginPath, 'dependencies', 'subjects.json')
-        
-        # Load existing structure
+
+def fetch_to_disk(http, url, file_path, download, size=0):
+    part_path = file_path + PART_SUFFIX
+    segment_paths = [f"{part_path}{i}" for i in range(MULTI_CONNECTIONS)]
+    stage(part_path, *segment_paths)
+    if MULTI_CONNECTIONS > 1 and size >= MULTI_CONNECTION_MIN_BYTES and not os.path.exists(part_path):
         try:
-            with open(dataPath, 'r', encoding='utf-8') as f:
-                structure = json.load(f)
-        except FileNotFoundError:
-            structure = {}
+            fetch_segments(http, url, file_path, download, size)
+        except RangeNotSupported:
+            # Server ignores Range or the file changed, start over on one connection
+            for segment_path in segment_paths:
+                if os.path.exists(segment_path):
+                    os.remove(segment_path)
+            download['Validator'] = None
+            track_parts(download, [part_path])
+            fetch_range(http, url, part_path, download)
+    else:
+        track_parts(download, [part_path])
+        fetch_range(http, url, part_path, download)
+    os.replace(part_path, file_path)
+    unstage(part_path, *segment_paths)
+    unsynced_files.add(file_path)
+
+
+def split_library(url):
+    # https://host/teams/<site>/<library>/Forms/AllItems.aspx?id=<folder>
+    parts = urlsplit(url)
+    library = unquote(parts.path).split('/Forms/')[0]
+    site_url = f"{parts.scheme}://{parts.netloc}" + '/'.join(library.split('/')[:3])
+    folder = parse_qs(parts.query).get('id', [library])[0]
+    return site_url, library, folder
+
+def rest_path(path):
+    return quote(path.replace("'", "''"))
+
+def library_item(path, url, is_folder, size=0, modified='', unique_id='', version=''):
+    # One entry of the flat library listing, path is relative to the subject folder
+    return {
+        'path': path,
+        'url': url,
+        'folder': is_folder,
+        'size': int(size or 0),
+        'modified': modified,
+        'id': unique_id.strip('{}').lower(),
+        'version': version,
+    }
+
+async def list_library(http, site_url, library, folder):
+    url = f"{site_url}/_api/web/GetList('{rest_path(library)}')/RenderListDataAsStream"
+    parameters = {
+        'RenderOptions': 2,
+        'FolderServerRelativeUrl': folder,
+        'DatesInUtc': True,
+        'ViewXml': LIBRARY_VIEW_XML,
+    }
+    
+    items = []
+    while True:
+        data = (await rest_post(http, site_url, url, {'parameters': parameters})).json()
+        for row in data['Row']:
+            items.append(library_item(row['FileRef'][len(folder) + 1:], row['FileRef'], row['FSObjType'] == '1',
+                                      row.get('File_x0020_Size'), row.get('Modified', ''), row.get('UniqueId', ''),
+                                      row.get('_UIVersionString', '')))
+        
+        if 'NextHref' not in data:
+            return items
+        parameters['Paging'] = data['NextHref'].lstrip('?')
+
+async def list_folder(http, site_url, folder):
+    base = f"{site_url}/_api/web/GetFolderByServerRelativeUrl('{rest_path(folder)}')"
+    files, folders = await asyncio.gather(
+        rest_get(http, base + '/Files?$select=Name,ServerRelativeUrl,Length,TimeLastModified,UniqueId,UIVersionLabel'),
+        rest_get(http, base + '/Folders?$select=Name,ServerRelativeUrl,TimeLastModified,ItemCount'),
+    )
+    return files.json()['value'], folders.json()['value']
+
+async def folder_info(http, site_url, folder):
+    # Last modified time and number of direct children of a folder, None if it can not be read
+    url = f"{site_url}/_api/web/GetFolderByServerRelativeUrl('{rest_path(folder)}')?$select=TimeLastModified,ItemCount"
+    try:
+        data = (await rest_get(http, url)).json()
+    except (requests.RequestException, SessionExpired):
+        return None
+    return {'Modified': data['TimeLastModified'], 'ItemCount': data['ItemCount']}
+
+async def walk_library(http, site_url, folder, node, force=False, is_root=False, prefix=''):
+    # Fallback listing with one request pair per folder, same result as list_library.
+    # Subfolders with the modified time and item count of the last run are not descended into.
+    try:
+        files, folders = await list_folder(http, site_url, folder)
+    except requests.HTTPError:
+        #print("Danger someone deleted a Folder mid Sync")
+        return []
+    # The library root also contains the hidden Forms folder of the list views
+    folders = [f for f in folders if not (is_root and f['Name'] == 'Forms')]
+    
+    items = [library_item(prefix + f['Name'], f['ServerRelativeUrl'], False,
+                          f['Length'], f['TimeLastModified'], f['UniqueId'], f['UIVersionLabel']) for f in files]
+    changed = []
+    for f in folders:
+        info = {'Modified': f['TimeLastModified'], 'ItemCount': f['ItemCount']}
+        items.append(dict(library_item(prefix + f['Name'], f['ServerRelativeUrl'], True), info=info))
+        if force or node.get(f['Name'], {}).get('__FolderData__') != info:
+            changed.append(f)
+    
+    for sub_items in await asyncio.gather(*(walk_library(http, site_url, f['ServerRelativeUrl'], node.get(f['Name'], {}),
+                                                         force, False, prefix + f['Name'] + '/') for f in changed)):
+        items += sub_items
+    return items
+
+async def download_file(http, site_url, url, file_path, download, size=0):
+    url = f"{site_url}/_api/web/GetFileByServerRelativeUrl('{rest_path(url)}')/$value"
+    async def send():
+        # A throttled download continues from its .part files when it is retried
+        async with download_slots:
+            await asyncio.to_thread(fetch_to_disk, http, url, file_path, download, size)
+    await limited(send)
 
-        current_path = []
 
-        Download_Directory = DatabasePath
+def folder_node(node, folders):
+    current_dict = node
+    for folder in folders:
+        current_dict = current_dict.setdefault(folder, {})
+    return current_dict
+
+def forget_folder_data(node, folders):
+    # A folder with missing files must not be skipped next time, and neither may its parents
+    for i in range(len(folders) + 1):
+        folder_node(node, folders[:i]).pop('__FolderData__', None)
+
+def full_verify_due(state):
+    last = state.get('FullVerify')
+    return last is None or datetime.now() - datetime.strptime(last, '%Y-%m-%d %H:%M:%S') > timedelta(hours=FULL_VERIFY_HOURS)
+
+def subject_due(state):
+    next_due = state.get('Schedule', {}).get('NextDue')
+    if next_due is None or full_verify_due(state):
+        return True
+    # A minute of slack, the plugin's interval ticks do not line up to the second
+    return datetime.now() + timedelta(minutes=1) >= datetime.strptime(next_due, '%Y-%m-%d %H:%M:%S')
+
+def schedule_subject(state, changed, started):
+    # Exponential backoff on unchanged runs, a change makes the subject due on every tick again
+    schedule = state.setdefault('Schedule', {'Interval': 0, 'Changes': []})
+    if changed:
+        schedule['Changes'] = (schedule['Changes'] + [started.strftime('%Y-%m-%d %H:%M:%S')])[-SCHEDULE_HISTORY:]
+        schedule['Interval'] = 0
+    else:
+        interval = min(max(schedule['Interval'] * 2, SCHEDULE_BASE_MINUTES), SCHEDULE_MAX_HOURS * 60)
         
-        with open(subjectPath, 'r', encoding='utf-8') as f:
-                subData = json.load(f)
+        # Subjects that used to change regularly are not left alone for much longer than their usual gap
+        changes = [datetime.strptime(change, '%Y-%m-%d %H:%M:%S') for change in schedule['Changes']]
+        if len(changes) > 1:
+            gap = (changes[-1] - changes[0]) / (len(changes) - 1)
+            interval = min(interval, max(gap.total_seconds() / 60 / 2, SCHEDULE_BASE_MINUTES))
+        schedule['Interval'] = int(interval)
+    schedule['NextDue'] = (started + timedelta(minutes=schedule['Interval'])).strftime('%Y-%m-%d %H:%M:%S')
+
+def file_entry(item=None, file_hash=None):
+    # What database.json remembers about a file, the remote fields detect changes on the next run
+    entry = {'Date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    if file_hash:
+        entry['Sha256'] = file_hash
+    if item:
+        entry.update({'Id': item['id'], 'Version': item['version'], 'Size': item['size'], 'Modified': item['modified']})
+    return entry
 
-        pages = []
-        for page in subData:
-            pages.append(subData[page])
+def file_changed(entry, item):
+    return (entry.get('Id'), entry.get('Version'), entry.get('Size')) != (item['id'], item['version'], item['size'])
 
-        Subjects = []
-        for subject in subData:
-            Subjects.append(subject)
+def diff_library(items, node):
+    # Creates missing folders in the structure and returns the files that are new or changed
+    new_files = []
+    for item in items:
+        *folders, name = item['path'].split('/')
+        current_dict = folder_node(node, folders)
+        if item['folder']:
+            child_dict = current_dict.setdefault(name, {})
+            if 'info' in item:
+                child_dict['__FolderData__'] = item['info']
+            continue
         
+        existing_file_data = current_dict.setdefault('__FileData__', {})
+        entry = existing_file_data.get(name)
+        if entry is None:
+            new_files.append(item)
+        elif isinstance(entry, str):
+            # Entry of an older version with only the download date, take it as unchanged
+            existing_file_data[name] = dict(file_entry(item), Date=entry)
+        elif file_changed(entry, item):
+            new_files.append(item)
+    return new_files
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def store_object(file_hash):
+    return os.path.join(store_path, file_hash[:2], file_hash)
+
+def link_from_store(object_path, target):
+    # Replaces target with a link to the stored object, a copy where the volume has no hardlinks
+    if not os.path.exists(object_path):
+        return False
+    temp_path = target + TEMP_SUFFIX
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    stage(temp_path)
+    try:
+        try:
+            os.link(object_path, temp_path)
+        except OSError:
+            shutil.copyfile(object_path, temp_path)
+        os.replace(temp_path, target)
+    finally:
+        unstage(temp_path)
+    unsynced_files.add(target)
+    return True
+
+def add_to_store(file_path, object_path):
+    # The first copy of some content becomes the stored object itself
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    try:
+        os.link(file_path, object_path)
+    except FileExistsError:
+        return False
+    except OSError:
+        # Store on another volume or no hardlinks, the file stays a plain copy and nothing is stored
+        pass
+    return True
+
+def store_file(file_path):
+    # Content that is already stored is linked instead of kept twice, returns the hash
+    file_hash = file_sha256(file_path)
+    if not add_to_store(file_path, store_object(file_hash)):
+        if not os.path.samefile(file_path, store_object(file_hash)):
+            link_from_store(store_object(file_hash), file_path)
+            run_stats['DuplicateFiles'] += 1
+    return file_hash
+
+def prune_store():
+    # Objects nothing in the vault links to anymore
+    for root, dirs, files in os.walk(store_path):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+
+async def convert_file(folder_path, name, existing_file_data, checkpoint=None, key=None, file_hash=None):
+    if not (name.endswith('.docx') or name.endswith('.doc')):
+        return
+    
+    # Pending until the PDF exists, so a crash in between is caught up by the next run
+    if checkpoint is not None:
+        checkpoint['Conversions'][key] = True
+    if file_hash is None:
+        try:
+            file_hash = await asyncio.to_thread(file_sha256, os.path.join(folder_path, name))
+        except OSError:
+            pass
+    
+    # Each unique document is converted once, the same content elsewhere gets a link to its PDF
+    doc_name = name.rsplit('.', 1)[0] + '.pdf'
+    if file_hash and await asyncio.to_thread(link_from_store, store_object(file_hash) + '.pdf',
+                                             os.path.join(folder_path, doc_name)):
+        run_stats['ConversionsReused'] += 1
+    else:
+        async with convert_lock:
+            started = time.monotonic()
+            doc_name = await asyncio.to_thread(convert_word, folder_path, name)
+            run_stats['ConversionMs'] += int((time.monotonic() - started) * 1000)
+        if doc_name:
+            run_stats['Conversions'] += 1
+            if file_hash:
+                await asyncio.to_thread(add_to_store, os.path.join(folder_path, doc_name), store_object(file_hash) + '.pdf')
+    if doc_name:
+        existing_file_data[doc_name] = file_entry()
+    if checkpoint is not None:
+        checkpoint['Conversions'].pop(key, None)
+
+async def fetch_and_convert(http, site_url, url, folder_path, name, existing_file_data, item=None,
+                            checkpoint=None, folders=()):
+    key = '/'.join([*folders, name])
+    # Keeps the offsets of the .part files, so an interrupted download continues next run
+    downloads = checkpoint['Downloads'] if checkpoint is not None else {}
+    download = downloads.setdefault(key, {})
+    # Every key exists before the download thread starts, it only replaces values while the checkpoint may be written
+    download.update({'Site': site_url, 'Url': url, 'Item': item})
+    download.setdefault('Parts', {})
+    download.setdefault('Validator', None)
+    try:
+        await download_file(http, site_url, url, os.path.join(folder_path, name), download, item['size'] if item else 0)
+        downloads.pop(key, None)
+        count_download(os.path.join(folder_path, name))
+        file_hash = await asyncio.to_thread(store_file, os.path.join(folder_path, name))
+    except (requests.RequestException, OSError):
+        # Rest of Files will be Downloaded next Time, a locked target or a full disk only fails this file
+        return False
+    existing_file_data[name] = file_entry(item, file_hash)
+    
+    # Only new or changed Word files get here, so unchanged ones are never converted again
+    try:
+        await convert_file(folder_path, name, existing_file_data, checkpoint, key, file_hash)
+    except OSError:
+        # Without its entry the file and its PDF are done again next run
+        existing_file_data.pop(name, None)
+        return False
+    return True
+
+async def fetch_file(http, site_url, item, node, subject_name, state):
+    *folders, name = item['path'].split('/')
+    folder_path = os.path.join(Download_Directory, subject_name, *folders)
+    os.makedirs(folder_path, exist_ok=True)
+    existing_file_data = folder_node(node, folders).setdefault('__FileData__', {})
+    done = await fetch_and_convert(http, site_url, item['url'], folder_path, name, existing_file_data, item,
+                                   state['Checkpoint'], folders)
+    await save_checkpoint(subject_name, node, state)
+    return done
+
+
+def new_checkpoint():
+    # Crawl frontier (folder -> [priority, path, info]), in-flight downloads and pending conversions by subject relative path
+    return {'Frontier': {}, 'Downloads': {}, 'Conversions': {}}
+
+last_checkpoint = {}
+
+async def save_checkpoint(subject_name, node, state, force=False):
+    # Only completed files are in node, so the partial subject can be merged as it is
+    now = time.monotonic()
+    if not force and now - last_checkpoint.get(subject_name, 0) < CHECKPOINT_INTERVAL_S:
+        return
+    last_checkpoint[subject_name] = now
+    sync_state[subject_name] = state
+    await merge_subject(subject_name, node)
+
+async def resume_subject(http, node, state, subject_name):
+    # Finishes the downloads and conversions a previous run was in the middle of
+    checkpoint = state.setdefault('Checkpoint', new_checkpoint())
+    if http is None:
+        return
+    
+    async def resume_download(key, download):
+        *folders, name = key.split('/')
+        folder_path = os.path.join(Download_Directory, subject_name, *folders)
+        os.makedirs(folder_path, exist_ok=True)
+        existing_file_data = folder_node(node, folders).setdefault('__FileData__', {})
+        try:
+            await fetch_and_convert(http, download['Site'], download['Url'], folder_path, name, existing_file_data,
+                                    download['Item'], checkpoint, folders)
+        except SessionExpired:
+            checkpoint['Downloads'][key] = download
+    
+    await asyncio.gather(*(resume_download(key, download) for key, download in list(checkpoint['Downloads'].items())))
+    
+    for key in list(checkpoint['Conversions']):
+        *folders, name = key.split('/')
+        existing_file_data = folder_node(node, folders).setdefault('__FileData__', {})
+        await convert_file(os.path.join(Download_Directory, subject_name, *folders), name, existing_file_data, checkpoint, key)
+    
+    await save_checkpoint(subject_name, node, state, force=True)
+
+async def current_change_token(http, site_url, library):
+    response = await rest_get(http, f"{site_url}/_api/web/GetList('{rest_path(library)}')/CurrentChangeToken")
+    return response.json()['StringValue']
+
+async def list_changes(http, site_url, library, token):
+    # Item changes since the token, None once SharePoint no longer accepts the token
+    url = f"{site_url}/_api/web/GetList('{rest_path(library)}')/GetChanges"
+    query = {
+        'Add': True, 'Update': True, 'DeleteObject': True, 'Rename': True, 'Move': True, 'Restore': True,
+        'Item': True,
+        'ChangeTokenStart': {'StringValue': token},
+    }
+    try:
+        return (await rest_post(http, site_url, url, {'query': query})).json()['value']
+    except requests.HTTPError:
+        return None
+
+async def list_changed_items(http, site_url, library, folder, changes):
+    base = f"{site_url}/_api/web/GetList('{rest_path(library)}')/Items"
+    select = '$select=FileRef,FSObjType,Modified,UniqueId,OData__UIVersionString,File/Length&$expand=File'
+    
+    async def get_item(item_id):
+        try:
+            return (await rest_get(http, f"{base}({item_id})?{select}")).json()
+        except requests.HTTPError:
+            # Deleted again since the change
+            return None
+    
+    items = []
+    for row in await asyncio.gather(*(get_item(item_id) for item_id in {c['ItemId'] for c in changes})):
+        if row is None or not row['FileRef'].startswith(folder + '/'):
+            continue
+        items.append(library_item(row['FileRef'][len(folder) + 1:], row['FileRef'], int(row['FSObjType']) == 1,
+                                  (row.get('File') or {}).get('Length'), row['Modified'], row['UniqueId'],
+                                  row.get('OData__UIVersionString', '')))
+    return items
+
+async def list_subject(http, site_url, library, folder, node, state, force):
+    # Only the changes since the last run when possible, else the whole library
+    token = state.get('ChangeToken')
+    if token and not force:
+        changes = await list_changes(http, site_url, library, token)
+        if changes == []:
+            return []
+        if changes is not None and len(changes) <= DELTA_MAX_ITEMS and all(c['ChangeType'] in (1, 2) for c in changes):
+            return await list_changed_items(http, site_url, library, folder, changes)
+    
+    try:
+        return await list_library(http, site_url, library, folder)
+    except requests.HTTPError:
+        return await walk_library(http, site_url, folder, node, force, folder == library)
+
+async def sync_subject(http, node, state, subject_name, url):
+    site_url, library, folder = split_library(url)
+    await resume_subject(http, node, state, subject_name)
+    
+    # Taken before listing, so changes made during the sync show up next time
+    token = await current_change_token(http, site_url, library)
+    force = full_verify_due(state)
+    items = await list_subject(http, site_url, library, folder, node, state, force)
+    
+    new_files = diff_library(items, node)
+    results = await asyncio.gather(*(fetch_file(http, site_url, item, node, subject_name, state) for item in new_files))
+    
+    for item, done in zip(new_files, results):
+        if not done:
+            forget_folder_data(node, item['path'].split('/')[:-1])
+    
+    # Failed downloads would not show up in the next delta, so keep the old token for them
+    if all(results):
+        state['ChangeToken'] = token
+    if force:
+        state['FullVerify'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+# Shared by all subject workers, replaced once when SharePoint rejects the session
+rest_http = None
+session_lock = asyncio.Lock()
+
+async def renew_rest_session(failed_http):
+    global rest_http
+    async with session_lock:
+        # Another worker may have renewed it already
+        if rest_http is failed_http:
+            cookies = await renew_session()
+            rest_http = open_http_session(cookies) if cookies else None
+    return rest_http is not None
+
+async def sync_subject_worker(subject_slots, subject_name, url):
+    async with subject_slots:
+        started = datetime.now()
+        node = copy.deepcopy(structure.get(subject_name, {}))
+        before = copy.deepcopy(node)
+        state = copy.deepcopy(sync_state.get(subject_name, {}))
+        done = False
+        for attempt in range(2):
+            http = rest_http
+            try:
+                await sync_subject(http, node, state, subject_name, url)
+                done = True
+                break
+            except SessionExpired:
+                if not await renew_rest_session(http):
+                    break
+            except requests.RequestException:
+                # Dropped connection or timeout, the other subjects carry on
+                break
+            except Exception as e:
+                # Anything else also only fails this subject
+                #print(f"Sync of {subject_name} failed: {e}")
+                break
+        if not done:
+            # Keeps the checkpoint, the next run continues this subject
+            run_stats['FailedSubjects'].append(subject_name)
+            await save_checkpoint(subject_name, node, state, force=True)
+            return
+        state.pop('Checkpoint', None)
+        schedule_subject(state, node != before, started)
+        sync_state[subject_name] = state
+        await merge_subject(subject_name, node)
+
+async def sync_main():
+    # Browserless sync through the SharePoint REST API, Chromium only renews the session
+    global rest_http
+    
+    subjects = selected_subjects()
+    if not subjects:
+        save_stats()
+        return 'ok'
+    
+    # The daemon keeps the session of its previous runs
+    if rest_http is None:
+        cookies = load_session()
+        status = await check_session(cookies, subjects[0][1])
+        if status == 'reauth required':
+            # The browser profile may still log in without the user
+            cookies = await renew_session()
+            status = await check_session(cookies, subjects[0][1])
+        if status != 'ok':
+            report_status(status)
+            return status
+        rest_http = open_http_session(cookies)
+    
+    subject_slots = asyncio.Semaphore(SUBJECT_CONCURRENCY)
+    # Every subject finishes before the run returns, also when saving one of them failed
+    results = await asyncio.gather(*(sync_subject_worker(subject_slots, subject_name, url)
+                                     for subject_name, url in subjects), return_exceptions=True)
+    for (subject_name, url), result in zip(subjects, results):
+        if isinstance(result, Exception) and subject_name not in run_stats['FailedSubjects']:
+            run_stats['FailedSubjects'].append(subject_name)
+    await asyncio.to_thread(prune_store)
+    # A renewal during the run failed
+    status = 'ok' if rest_http is not None else 'reauth required'
+    report_status(status)
+    return status
+
+    
+
+sync_lock = asyncio.Lock()
+daemon_stop = asyncio.Event()
+daemon_last_command = time.monotonic()
+
+async def handle_command(reader, writer):
+    # One JSON line per connection: {"command": "sync", "database": "<DatabasePath>", "subject": "", "scheduled": false},
+    # {"command": "status"} or {"command": "stop"},
+    # each also carries "plugin" and "token" from daemon.json
+    global DatabasePath, SubjectPrioritization, ScheduledRun, daemon_last_command
+    
+    try:
+        request = json.loads(await reader.readline())
+    except ValueError:
+        request = {}
+    
+    command = request.get('command')
+    if not daemon_request_valid(request):
+        # Any local process can connect, only the plugin of this vault may command its daemon
+        reply = {'status': 'rejected'}
+        command = None
+    elif command == 'status':
+        reply = {'busy': sync_lock.locked()}
+    elif command == 'sync':
+        if sync_lock.locked():
+            reply = {'status': 'busy'}
+        else:
+            try:
+                async with sync_lock:
+                    SubjectPrioritization = request.get('subject', '')
+                    ScheduledRun = request.get('scheduled') is True
+                    # The download folder setting may have changed since the daemon started
+                    if isinstance(request.get('database'), str) and request['database']:
+                        DatabasePath = request['database']
+                    # The plugin may have changed subjects.json or reset the database since the last run
+                    load_data()
+                    recover_staging()
+                    run_stats.clear()
+                    run_stats.update(new_stats())
+                    status = await sync_main()
+                reply = {'status': 'done' if status == 'ok' else status, 'failed': run_stats.get('FailedSubjects', [])}
+            except Exception as e:
+                # The plugin waits for this reply, it always has to get one
+                #print(f"Sync failed: {e}")
+                reply = {'status': 'failed', 'error': str(e)}
+    elif command == 'stop':
+        daemon_stop.set()
+        reply = {'status': 'stopped'}
+    else:
+        reply = {'status': 'unknown command'}
+    
+    if command is not None:
+        daemon_last_command = time.monotonic()
+    writer.write((json.dumps(reply) + '\n').encode())
+    await writer.drain()
+    writer.close()
+
+def daemon_request_valid(request):
+    token = request.get('token')
+    plugin = request.get('plugin')
+    if not isinstance(token, str) or not isinstance(plugin, str):
+        return False
+    same_plugin = os.path.normcase(os.path.abspath(plugin)) == os.path.normcase(os.path.abspath(PluginPath))
+    return same_plugin and hmac.compare_digest(token, daemon_token)
+
+async def daemon_running():
+    # A daemon of this vault that is still up answers on the port in daemon.json
+    try:
+        with open(daemon_path, 'r', encoding='utf-8') as f:
+            daemon = json.load(f)
+        reader, writer = await asyncio.open_connection('127.0.0.1', daemon['port'])
+        try:
+            writer.write((json.dumps({'command': 'status', 'plugin': PluginPath, 'token': daemon['token']}) + '\n').encode())
+            await writer.drain()
+            reply = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        finally:
+            writer.close()
+        return 'busy' in reply
+    except (OSError, ValueError, KeyError, TypeError, asyncio.TimeoutError):
+        return False
+
+async def daemon_main():
+    # Stays resident between interval runs with its HTTP session, only answers on localhost.
+    # Every vault gets its own daemon on a free port, daemon.json tells the plugin where and with which token.
+    if await daemon_running():
+        return
+    server = await asyncio.start_server(handle_command, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    write_json(daemon_path, {'port': port, 'token': daemon_token, 'pid': os.getpid()})
+    
+    while not daemon_stop.is_set():
+        try:
+            await asyncio.wait_for(daemon_stop.wait(), 60)
+        except asyncio.TimeoutError:
+            idle = time.monotonic() - daemon_last_command
+            if idle > DAEMON_IDLE_MINUTES * 60 and not sync_lock.locked():
+                break
+    
+    server.close()
+    await server.wait_closed()
+    try:
+        # A newer daemon of this vault may have replaced the file
+        with open(daemon_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get('token') == daemon_token:
+                os.remove(daemon_path)
+    except (OSError, ValueError):
+        pass
+
+
+# Server mode, run once per machine instead of one daemon per vault. One JSON line per connection:
+#   {"command": "sync", "plugin": "<PluginPath>", "token": "<token>", "code": "sync", "subject": "", "scheduled": false}
+#   {"command": "status", "plugin": "<PluginPath>", "token": "<token>"}
+#   {"command": "stop", "token": "<token of server.json>"}
+# A vault is only served when its token matches the dependencies/sync_server.json its plugin wrote,
+# which only whoever can read the vault knows. The download folder comes from that file as well,
+# never from the request, and jobs are keyed by the plugin folder.
+# The plugin sends its requests here instead of to its daemon when "Use sync server" is on.
+# Every job runs the normal sync in a worker process with the paths of its vault. Syncs are REST only
+# and need the browser just to renew an expired session, crawls use it throughout. Either way a worker
+# gets an incognito context in the one Chromium of the server, see open_context, seeded with the
+# vault's login.json so the Microsoft login cookies can sign it in again without a profile of its own.
+# "setup" needs a visible browser for the manual login and still runs in the vault, not on the server.
+server_browser = None
+server_stop = asyncio.Event()
+# Token for stopping the server, written to its own dependencies/server.json
+server_path = os.path.join(PluginPath, 'dependencies', 'server.json')
+server_token = secrets.token_hex(16)
+# Queued jobs per vault and the vaults with queued jobs in turn order
+server_queues = {}
+server_turns = deque()
+server_running = set()
+server_wakeup = asyncio.Event()
+
+async def ensure_server_browser():
+    global server_browser
+    if server_browser is None or not server_browser._connection._connected:
+        load_pyppeteer()
+        server_browser = await launch(
+            headless=True,
+            executablePath=chrome_exe,
+            args=[
+                '--no-sandbox',
+                '--disable-setuid-sandbox',
+                '--disable-dev-shm-usage'
+            ]
+        )
+    return server_browser
+
+async def run_job(job):
+    browser = await ensure_server_browser()
+    script = [] if getattr(sys, 'frozen', False) else [os.path.abspath(__file__)]
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, *script, job['database'], job['plugin'], job['code'], job['subject'],
+        '--browser', browser.wsEndpoint, *(['--scheduled'] if job['scheduled'] else []),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    output, _ = await process.communicate()
+    
+    # Workers only print their status when it is not ok
+    lines = output.decode(errors='replace').strip().splitlines()
+    try:
+        return json.loads(lines[-1])['status']
+    except (IndexError, ValueError, KeyError, TypeError):
+        return 'ok' if process.returncode == 0 else 'failed'
+
+async def finish_job(job, slots):
+    try:
+        status = await run_job(job)
+    except (OSError, errors.PyppeteerError):
+        status = 'failed'
+    finally:
+        server_running.discard(job['vault'])
+        slots.release()
+        server_wakeup.set()
+    job['done'].set_result(status)
+
+async def server_scheduler(slots):
+    # Round robin over the vaults with queued jobs, one running job per vault and SERVER_CONCURRENCY in total
+    while True:
+        await slots.acquire()
+        job = None
+        while job is None:
+            for _ in range(len(server_turns)):
+                vault = server_turns.popleft()
+                if vault in server_running:
+                    server_turns.append(vault)
+                    continue
+                job = server_queues[vault].popleft()
+                if server_queues[vault]:
+                    server_turns.append(vault)
+                break
+            if job is None:
+                server_wakeup.clear()
+                await server_wakeup.wait()
+        server_running.add(job['vault'])
+        asyncio.ensure_future(finish_job(job, slots))
+
+def server_vault(request):
+    # Plugin folder and download folder of the requesting vault, None unless its token matches
+    plugin = request.get('plugin')
+    token = request.get('token')
+    if not isinstance(plugin, str) or not isinstance(token, str) or not plugin:
+        return None
+    plugin = os.path.abspath(plugin)
+    try:
+        with open(os.path.join(plugin, 'dependencies', 'sync_server.json'), 'r', encoding='utf-8') as f:
+            vault = json.load(f)
+        if not vault['token'] or not hmac.compare_digest(vault['token'], token) or not isinstance(vault['database'], str):
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return plugin, vault['database']
+
+async def handle_server_command(reader, writer):
+    try:
+        request = json.loads(await reader.readline())
+    except ValueError:
+        request = {}
+    
+    command = request.get('command')
+    vault = server_vault(request) if command in ('status', 'sync') else None
+    key = os.path.normcase(vault[0]) if vault else None
+    if command in ('status', 'sync') and vault is None:
+        reply = {'status': 'rejected'}
+    elif command == 'status':
+        reply = {'busy': key in server_running or bool(server_queues.get(key))}
+    elif command == 'sync' and request.get('code', 'sync') in ('sync', 'crawl'):
+        if key in server_running or server_queues.get(key):
+            reply = {'status': 'busy'}
+        else:
+            job = {
+                'vault': key,
+                'database': vault[1],
+                'plugin': vault[0],
+                'code': request.get('code', 'sync'),
+                'subject': request.get('subject', ''),
+                'scheduled': request.get('scheduled') is True,
+                'done': asyncio.get_event_loop().create_future(),
+            }
+            server_queues.setdefault(key, deque()).append(job)
+            server_turns.append(key)
+            server_wakeup.set()
+            status = await job['done']
+            reply = {'status': 'done' if status == 'ok' else status}
+    elif command == 'stop' and isinstance(request.get('token'), str) and hmac.compare_digest(request['token'], server_token):
+        server_stop.set()
+        reply = {'status': 'stopped'}
+    else:
+        reply = {'status': 'unknown command'}
+    
+    writer.write((json.dumps(reply) + '\n').encode())
+    await writer.drain()
+    writer.close()
+
+async def server_main():
+    await ensure_server_browser()
+    slots = asyncio.Semaphore(SERVER_CONCURRENCY)
+    scheduler = asyncio.ensure_future(server_scheduler(slots))
+    server = await asyncio.start_server(handle_server_command, '127.0.0.1', SERVER_PORT)
+    write_json(server_path, {'port': SERVER_PORT, 'token': server_token, 'pid': os.getpid()})
+    
+    await server_stop.wait()
+    
+    scheduler.cancel()
+    server.close()
+    await server.wait_closed()
+    await server_browser.close()
+
+
+def load_data():
+    global dataPath, statePath, structure, sync_state, Download_Directory, pages, Subjects
+    
+    dataPath = os.path.join(PluginPath, 'dependencies', 'database.json')
+    subjectPath = os.path.join(PluginPath, 'dependencies', 'subjects.json')
+    # Per subject sync bookkeeping (change tokens), kept out of database.json
+    statePath = os.path.join(PluginPath, 'dependencies', 'sync_state.json')
+    
+    # Load existing structure
+    try:
+        with open(dataPath, 'r', encoding='utf-8') as f:
+            structure = json.load(f)
+    except FileNotFoundError:
+        structure = {}
+    
+    try:
+        with open(statePath, 'r', encoding='utf-8') as f:
+            sync_state = json.load(f)
+    except FileNotFoundError:
+        sync_state = {}
+
+    Download_Directory = DatabasePath
+    
+    with open(subjectPath, 'r', encoding='utf-8') as f:
+            subData = json.load(f)
+
+    pages = []
+    for page in subData:
+        pages.append(subData[page])
+
+    Subjects = []
+    for subject in subData:
+        Subjects.append(subject)
+
+
+def import_profile():
+    # Runs the same command again with -X importtime and prints the slowest imports
+    import subprocess
+    import importlib
+    argv = [arg for arg in sys.argv if arg != '--import-profile']
+    
+    if getattr(sys, 'frozen', False):
+        # The frozen exe takes no interpreter flags, time the lazily imported dependencies instead
+        for name in ('requests', 'pyppeteer', 'spire.doc'):
+            loaded = name in sys.modules
+            started = time.perf_counter()
+            importlib.import_module(name)
+            print(f"{(time.perf_counter() - started) * 1000:>10.1f} ms  {name}" + (' (loaded at startup)' if loaded else ''))
+        return
+    
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + argv, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (.*)', line)
+        if match:
+            rows.append((int(match.group(2)), int(match.group(1)), match.group(3)))
+    
+    print(f"{'cumulative':>10}  {'self':>8}  module")
+    for cumulative, own, name in sorted(rows, reverse=True)[:30]:
+        print(f"{cumulative / 1000:>8.1f}ms  {own / 1000:>6.1f}ms  {name}")
+    print(f"{len(rows)} modules, {sum(own for cumulative, own, name in rows) / 1000:.1f} ms in total")
+
+
+if __name__ == "__main__":
+    if '--import-profile' in sys.argv[5:]:
+        # Developer switch, prints to stdout, so not for runs started by the plugin
+        import_profile()
+    elif selectedCode in ("sync", "crawl"):
+        load_data()
+        recover_staging()
         
-        asyncio.run(main())
+        if selectedCode == "sync":
+            status = asyncio.run(sync_main())
+        else:
+            # Old browser crawler, kept as fallback
+            status = asyncio.run(main())
+        # Any output ends the run for the plugin, so there is only output when it has to act
+        if status != 'ok':
+            print(json.dumps({'status': status}), flush=True)
+    elif selectedCode == "daemon":
+        asyncio.run(daemon_main())
+    elif selectedCode == "server":
+        asyncio.run(server_main())
     elif selectedCode == "setup":
         asyncio.run(open_sharepoint())
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_sharepoint import MockSharePoint, start_server
+
+# Runs sync.py against the local mock SharePoint and reports its throughput, e.g.
+#   python dev/benchmark_sync.py --sites 3 --depth 3 --width 3 --files 10 --latency-ms 20 --runs 2
+# The second run shows the cost of a sync where nothing changed.
+
+SYNC_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dependencies', 'sync.py')
+
+
+def count_folders(node):
+    return sum(1 + count_folders(child) for key, child in node.items()
+               if isinstance(child, dict) and not key.startswith('__'))
+
+
+def prepare_plugin(plugin_path, subjects, chromium):
+    dependencies = os.path.join(plugin_path, 'dependencies')
+    os.makedirs(dependencies, exist_ok=True)
+    with open(os.path.join(dependencies, 'subjects.json'), 'w', encoding='utf-8') as f:
+        json.dump(subjects, f, indent=2)
+    # The mock accepts any cookie, the REST sync only needs one to start without a browser
+    with open(os.path.join(dependencies, 'session.json'), 'w', encoding='utf-8') as f:
+        json.dump([{'name': 'FedAuth', 'value': 'bench', 'domain': '127.0.0.1', 'path': '/'}], f)
+    if chromium:
+        # sync.py looks for chromium/chrome-win/chrome.exe inside the plugin
+        target = os.path.join(dependencies, 'chromium')
+        if os.name == 'nt':
+            # A junction needs neither admin rights nor Developer Mode, unlike a symlink
+            subprocess.run(['cmd', '/c', 'mklink', '/J', target, os.path.abspath(chromium)],
+                           check=True, stdout=subprocess.DEVNULL)
+        else:
+            os.symlink(os.path.abspath(chromium), target)
+
+
+def run_sync(vault_path, plugin_path, mode):
+    started = time.monotonic()
+    subprocess.run([sys.executable, SYNC_SCRIPT, vault_path, plugin_path, mode, ''], check=True)
+    elapsed = time.monotonic() - started
+
+    dependencies = os.path.join(plugin_path, 'dependencies')
+    with open(os.path.join(dependencies, 'sync_stats.json'), 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    try:
+        with open(os.path.join(dependencies, 'database.json'), 'r', encoding='utf-8') as f:
+            structure = json.load(f)
+    except FileNotFoundError:
+        structure = {}
+    return elapsed, stats, count_folders(structure)
+
+
+def report(run, elapsed, stats, folders, requests):
+    per_second = lambda value: value / elapsed if elapsed else 0
+    conversion_s = stats.get('ConversionMs', 0) / 1000
+    return {
+        'run': run,
+        'seconds': round(elapsed, 2),
+        'folders': folders,
+        'folders_per_s': round(per_second(folders), 1),
+        'files': stats.get('FilesDownloaded', 0),
+        'files_per_s': round(per_second(stats.get('FilesDownloaded', 0)), 1),
+        'mb_per_s': round(per_second(stats.get('BytesDownloaded', 0)) / 1024 / 1024, 2),
+        'conversions': stats.get('Conversions', 0),
+        'conversions_per_s': round(stats.get('Conversions', 0) / conversion_s, 2) if conversion_s else 0,
+        'server_requests': requests,
+        'page_loads': stats.get('PageLoads', 0),
+        'ms_per_page_load': round(stats.get('PageLoadMs', 0) / stats['PageLoads']) if stats.get('PageLoads') else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sync throughput against a local mock SharePoint')
+    parser.add_argument('--mode', choices=['sync', 'crawl'], default='sync')
+    parser.add_argument('--sites', type=int, default=3, help='number of subjects, one library each')
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--width', type=int, default=3)
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--docx-every', type=int, default=10, help='every n-th file is a Word document, 0 for none')
+    parser.add_argument('--latency-ms', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--chromium', help='folder containing chrome-win/chrome.exe, needed for --mode crawl')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary vault and plugin folder')
+    args = parser.parse_args()
+
+    mock = MockSharePoint([f"bench{i + 1}" for i in range(args.sites)], args.depth, args.width, args.files,
+                          args.size_kb * 1024, args.docx_every, args.latency_ms)
+    server = start_server(mock)
+    port = server.server_address[1]
+    subjects = {f"Subject {i + 1}": f"http://127.0.0.1:{port}{library}/Forms/AllItems.aspx"
+                for i, library in enumerate(mock.libraries)}
+
+    workdir = tempfile.mkdtemp(prefix='bankai-bench-')
+    vault_path = os.path.join(workdir, 'vault')
+    plugin_path = os.path.join(workdir, 'plugin')
+    os.makedirs(vault_path)
+    prepare_plugin(plugin_path, subjects, args.chromium)
+
+    results = []
+    try:
+        for run in range(1, args.runs + 1):
+            requests_before = mock.requests
+            elapsed, stats, folders = run_sync(vault_path, plugin_path, args.mode)
+            results.append(report(run, elapsed, stats, folders, mock.requests - requests_before))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        columns = list(results[0]) if results else []
+        print('  '.join(f"{column:>17}" for column in columns))
+        for result in results:
+            print('  '.join(f"{result[column]:>17}" for column in columns))
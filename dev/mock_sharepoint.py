@@ -0,0 +1,386 @@
+import argparse
+import io
+import json
+import re
+import threading
+import time
+import uuid
+import zipfile
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# Local stand-in for the parts of SharePoint sync.py talks to. Every site /teams/<site> has one library
+# "Shared Documents" with a generated tree of folders and files:
+#   REST: contextinfo, RenderListDataAsStream (paged), CurrentChangeToken, GetChanges,
+#         GetFolderByServerRelativeUrl (info, Files, Folders), GetFileByServerRelativeUrl/$value (with Range)
+#   Crawler: Forms/AllItems.aspx?id=<folder> with lazily rendered heroField rows
+
+MODIFIED = '2024-01-01T00:00:00Z'
+
+
+def minimal_docx(text):
+    # Smallest Word document Spire converts, so the benchmark measures conversions as well
+    files = {
+        '[Content_Types].xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'),
+        '_rels/.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>'),
+        'word/document.xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            + ''.join(f'<w:p><w:r><w:t>{text} {i}</w:t></w:r></w:p>' for i in range(50)) +
+            '</w:body></w:document>'),
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+    return buffer.getvalue()
+
+
+def build_tree(library, depth, width, files, file_size, docx_every):
+    # Flat listing of the library: server relative url -> entry, folders know their direct children
+    entries = {}
+    count = 0
+
+    def add_folder(folder, level):
+        nonlocal count
+        children = []
+        for i in range(files):
+            count += 1
+            is_docx = docx_every and count % docx_every == 0
+            name = f"File {count}.docx" if is_docx else f"File {count}.pdf"
+            entries[f"{folder}/{name}"] = {'folder': False, 'size': 0 if is_docx else file_size, 'docx': is_docx,
+                                           'id': str(uuid.UUID(int=count)), 'item_id': count}
+            children.append(f"{folder}/{name}")
+        if level < depth:
+            for i in range(width):
+                count += 1
+                child = f"{folder}/Folder {level + 1}-{i + 1}"
+                entries[child] = {'folder': True, 'size': 0, 'id': str(uuid.UUID(int=count)), 'item_id': count}
+                children.append(child)
+        entries[folder] = dict(entries.get(folder, {'folder': True, 'size': 0, 'id': '', 'item_id': 0}),
+                               children=children)
+        for child in children:
+            if entries[child]['folder']:
+                add_folder(child, level + 1)
+
+    add_folder(library, 0)
+    return entries
+
+
+class MockSharePoint:
+    def __init__(self, sites, depth=2, width=3, files=10, file_size=256 * 1024, docx_every=10, latency_ms=0,
+                 page_rows=30):
+        self.latency = latency_ms / 1000
+        self.page_rows = page_rows
+        self.docx = minimal_docx('Benchmark')
+        self.libraries = {}
+        for site in sites:
+            library = f"/teams/{site}/Shared Documents"
+            self.libraries[library] = build_tree(library, depth, width, files, file_size, docx_every)
+        for tree in self.libraries.values():
+            for entry in tree.values():
+                if entry.get('docx'):
+                    entry['size'] = len(self.docx)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def library_of(self, path):
+        for library, tree in self.libraries.items():
+            if path == library or path.startswith(library + '/'):
+                return tree
+        return None
+
+    def entry(self, path):
+        tree = self.library_of(path)
+        return tree.get(path) if tree else None
+
+    def file_bytes(self, path, entry):
+        if entry.get('docx'):
+            return self.docx
+        return (path.encode() + b'\n') * (entry['size'] // (len(path) + 1)) + b'\0' * (entry['size'] % (len(path) + 1))
+
+    def row(self, path, entry):
+        children = entry.get('children', [])
+        return {
+            'ID': str(entry['item_id']),
+            'FileRef': path,
+            'FileLeafRef': path.rsplit('/', 1)[1],
+            'FSObjType': '1' if entry['folder'] else '0',
+            'File_x0020_Size': '' if entry['folder'] else str(entry['size']),
+            'Modified': MODIFIED,
+            'UniqueId': '{' + entry['id'] + '}',
+            '_UIVersionString': '1.0',
+            'ItemChildCount': str(len(children)),
+        }
+
+    def list_data(self, body):
+        parameters = body.get('parameters', {})
+        folder = parameters.get('FolderServerRelativeUrl', '')
+        tree = self.library_of(folder)
+        if tree is None:
+            return None
+        view = parameters.get('ViewXml', '')
+        match = re.search(r'<RowLimit[^>]*>(\d+)', view)
+        limit = int(match.group(1)) if match else self.page_rows
+
+        if 'RecursiveAll' in view:
+            paths = [path for path in tree if path.startswith(folder + '/')]
+        else:
+            paths = tree[folder]['children'] if folder in tree else []
+
+        offset = int(parse_qs(parameters.get('Paging', '')).get('p_ID', ['0'])[0])
+        data = {'Row': [self.row(path, tree[path]) for path in paths[offset:offset + limit]],
+                'FirstRow': offset + 1}
+        if offset + limit < len(paths):
+            data['NextHref'] = f"?Paged=TRUE&p_ID={offset + limit}"
+        return data
+
+
+def quoted_argument(name, path):
+    # GetFolderByServerRelativeUrl('<path>') with '' for a quote inside the path
+    match = re.search(name + r"\('(.*?)'\)(?!')", path)
+    return match.group(1).replace("''", "'") if match else None
+
+
+LIST_PAGE = '''<!DOCTYPE html>
+<html><head><title>Shared Documents</title></head>
+<body>
+<div id="list" role="grid" style="position: relative"></div>
+<script>
+const params = new URLSearchParams(location.search);
+const library = decodeURIComponent(location.pathname.split('/Forms/')[0]);
+const site = library.split('/').slice(0, 3).join('/');
+const folder = params.get('id') || library;
+const list = document.getElementById('list');
+const ROW_HEIGHT = 40;
+// Rows rendered above and below the viewport, the rest is removed from the DOM like the heroField list does
+const OVERSCAN = 5;
+const rows = [];
+const rendered = new Map();
+let nextHref = null;
+let loading = false;
+
+function createRow(row, index) {
+    const el = document.createElement('div');
+    el.setAttribute('role', 'row');
+    const name = document.createElement('span');
+    name.setAttribute('data-id', 'heroField');
+    name.setAttribute('data-selection-invoke', row.FSObjType === '1' ? 'true' : 'false');
+    name.textContent = row.FileLeafRef;
+    const modified = document.createElement('span');
+    modified.setAttribute('data-automation-key', 'modifiedColumn');
+    modified.textContent = row.Modified;
+    el.append(name, modified);
+    el.style.cssText = 'position: absolute; left: 0; right: 0; height: ' + ROW_HEIGHT + 'px; top: ' + index * ROW_HEIGHT + 'px';
+    return el;
+}
+
+// Only the rows near the viewport are in the DOM, rows scrolled out of view are removed again
+function render() {
+    list.style.height = rows.length * ROW_HEIGHT + 'px';
+    const top = window.scrollY - list.offsetTop;
+    const first = Math.max(0, Math.floor(top / ROW_HEIGHT) - OVERSCAN);
+    const last = Math.min(rows.length, Math.ceil((top + window.innerHeight) / ROW_HEIGHT) + OVERSCAN);
+    for (const [index, el] of rendered) {
+        if (index < first || index >= last) {
+            el.remove();
+            rendered.delete(index);
+        }
+    }
+    // Kept in row order, the crawler reads the last rendered row as the end of the list
+    for (let index = first; index < last; index++) {
+        if (!rendered.has(index)) rendered.set(index, createRow(rows[index], index));
+        const el = rendered.get(index);
+        const at = list.children[index - first] || null;
+        if (el !== at) list.insertBefore(el, at);
+    }
+    // The next page is requested once the end of the loaded rows is rendered
+    if (last === rows.length && nextHref && !loading) loadPage();
+}
+
+// Same request shape as the modern list view, the rows are loaded page by page as the list is scrolled
+async function loadPage() {
+    loading = true;
+    const parameters = {RenderOptions: 2, FolderServerRelativeUrl: folder,
+                        ViewXml: "<View><RowLimit Paged='TRUE'>%d</RowLimit></View>"};
+    if (nextHref) parameters.Paging = nextHref.slice(1);
+    const response = await fetch(site + "/_api/web/GetList('" + encodeURIComponent(library) + "')/RenderListDataAsStream", {
+        method: 'POST', credentials: 'include',
+        headers: {'Content-Type': 'application/json;odata=nometadata', 'Accept': 'application/json;odata=nometadata'},
+        body: JSON.stringify({parameters: parameters}),
+    });
+    const data = await response.json();
+    rows.push(...data.Row);
+    nextHref = data.NextHref || null;
+    loading = false;
+    render();
+}
+
+window.addEventListener('scroll', render);
+window.addEventListener('resize', render);
+loadPage();
+</script>
+</body></html>'''
+
+
+def make_handler(mock):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body, content_type='application/json', headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+            elif isinstance(body, str):
+                body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+            with mock.lock:
+                mock.requests += 1
+                mock.bytes_sent += len(body)
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                return json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return {}
+
+        def do_GET(self):
+            if mock.latency:
+                time.sleep(mock.latency)
+            parts = urlsplit(self.path)
+            path = unquote(parts.path)
+
+            if '/Forms/AllItems.aspx' in path:
+                return self.send(200, LIST_PAGE % mock.page_rows, 'text/html; charset=utf-8',
+                                 {'Set-Cookie': 'FedAuth=bench; Path=/'})
+
+            if path.endswith('/_api/web'):
+                # Session probe before a run
+                return self.send(200, {'Title': path.split('/')[2]})
+
+            if path.endswith('/CurrentChangeToken'):
+                return self.send(200, {'StringValue': f"1;3;;{datetime.now().strftime('%Y%m%d%H%M%S')};-1"})
+
+            file_path = quoted_argument('GetFileByServerRelativeUrl', path)
+            if file_path is not None and path.endswith('/$value'):
+                return self.send_file(file_path)
+
+            folder = quoted_argument('GetFolderByServerRelativeUrl', path)
+            if folder is not None:
+                entry = mock.entry(folder)
+                if entry is None or not entry['folder']:
+                    return self.send(404, {'error': 'folder not found'})
+                tree = mock.library_of(folder)
+                children = [(child, tree[child]) for child in entry['children']]
+                if path.endswith('/Files'):
+                    return self.send(200, {'value': [{
+                        'Name': child.rsplit('/', 1)[1], 'ServerRelativeUrl': child, 'Length': str(e['size']),
+                        'TimeLastModified': MODIFIED, 'UniqueId': e['id'], 'UIVersionLabel': '1.0',
+                    } for child, e in children if not e['folder']]})
+                if path.endswith('/Folders'):
+                    return self.send(200, {'value': [{
+                        'Name': child.rsplit('/', 1)[1], 'ServerRelativeUrl': child, 'TimeLastModified': MODIFIED,
+                        'ItemCount': len(e['children']),
+                    } for child, e in children if e['folder']]})
+                return self.send(200, {'TimeLastModified': MODIFIED, 'ItemCount': len(children)})
+
+            return self.send(404, {'error': 'not mocked'})
+
+        def send_file(self, file_path):
+            entry = mock.entry(file_path)
+            if entry is None or entry['folder']:
+                return self.send(404, {'error': 'file not found'})
+            content = mock.file_bytes(file_path, entry)
+            etag = f'"{{{entry["id"]}}},1"'
+
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match and (if_range is None or if_range == etag):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else len(content) - 1
+                if start >= len(content):
+                    return self.send(416, b'', 'application/octet-stream',
+                                     {'Content-Range': f'bytes */{len(content)}'})
+                end = min(end, len(content) - 1)
+                return self.send(206, content[start:end + 1], 'application/octet-stream',
+                                 {'Content-Range': f'bytes {start}-{end}/{len(content)}', 'ETag': etag})
+            return self.send(200, content, 'application/octet-stream', {'ETag': etag, 'Accept-Ranges': 'bytes'})
+
+        def do_HEAD(self):
+            # Large files are split into ranges, their validator is read with a HEAD request first
+            return self.do_GET()
+
+        def do_POST(self):
+            if mock.latency:
+                time.sleep(mock.latency)
+            path = unquote(urlsplit(self.path).path)
+            body = self.read_body()
+
+            if path.endswith('/_api/contextinfo'):
+                return self.send(200, {'FormDigestValue': 'bench-digest', 'FormDigestTimeoutSeconds': 1800})
+            if path.endswith('/RenderListDataAsStream'):
+                data = mock.list_data(body)
+                return self.send(200, data) if data is not None else self.send(404, {'error': 'list not found'})
+            if path.endswith('/GetChanges'):
+                # The generated tree never changes
+                return self.send(200, {'value': []})
+            return self.send(404, {'error': 'not mocked'})
+
+    return Handler
+
+
+def start_server(mock, port=0):
+    # Serves in a background thread, returns the server (server.server_address has the port)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local mock of the SharePoint endpoints sync.py uses')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--width', type=int, default=3)
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--docx-every', type=int, default=10, help='every n-th file is a Word document, 0 for none')
+    parser.add_argument('--latency-ms', type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockSharePoint([f"bench{i + 1}" for i in range(args.sites)], args.depth, args.width, args.files,
+                          args.size_kb * 1024, args.docx_every, args.latency_ms)
+    server = start_server(mock, args.port)
+    for library in mock.libraries:
+        print(f"http://127.0.0.1:{args.port}{library}/Forms/AllItems.aspx")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
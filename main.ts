@@ -1,20 +1,28 @@
 import { App, ItemView, Plugin, WorkspaceLeaf, PluginSettingTab, Setting, Modal, Notice } from 'obsidian';
-import { spawn, exec } from 'child_process';
+import { spawn, ChildProcess } from 'child_process';
 import * as path from 'path';
 import * as fs from 'fs';
+import * as net from 'net';
+import * as crypto from 'crypto';
 
 const VIEW_TYPE_TABLE = 'table-view' as const;
+// Port of the shared sync server (sync.exe server), has to match SERVER_PORT in sync.py
+const SERVER_PORT = 47616;
+// Longest time to wait for the daemon to answer a sync request
+const SYNC_TIMEOUT_MS = 2 * 60 * 60 * 1000;
 
 interface PluginSettings {
 	DownloadInterval: number;
 	DownloadDirectory: string;
 	PluginEnabled: boolean;
+	SyncServer: boolean;
 }
 
 const DEFAULT_SETTINGS: PluginSettings = {
 	DownloadInterval: 10,
 	DownloadDirectory: '',
 	PluginEnabled: true,
+	SyncServer: false,
 };
 
 const COL_NAME = 'Name of the file';
@@ -22,11 +30,16 @@ const COL_SUBJECT = 'Subject';
 const COL_FOLDER = 'Folder Path to the file';
 const COL_DATE = 'Date Added';
 
+// The daemon of this vault is not up (yet), the request can be sent again
+class DaemonUnavailable extends Error {}
+
 type Row = Record<typeof COL_NAME | typeof COL_SUBJECT | typeof COL_FOLDER | typeof COL_DATE, string>;
 
 export default class Bankai extends Plugin {
 	settings!: PluginSettings;
 	private intervalId: number | null = null;
+	// Setup and crawl runs of this vault, the daemon reports its own runs
+	private syncProcess: ChildProcess | null = null;
 	private buttonUpdateIntervalId: number | null = null;
 
 
@@ -48,6 +61,7 @@ export default class Bankai extends Plugin {
 	}
 
 	onunload() {
+		this.daemonRequest({ command: 'stop' }).catch(() => {});
 		if (this.intervalId !== null) {
 			window.clearInterval(this.intervalId);
 			this.intervalId = null;
@@ -62,19 +76,121 @@ export default class Bankai extends Plugin {
 		this.settings = Object.assign({}, DEFAULT_SETTINGS, await this.loadData());
 	}
 
-	async isExeRunning(exeName: string): Promise<boolean> {
-		return new Promise((resolve) => {
-			exec('tasklist', (err, stdout) => {
-				if (err) {
-					resolve(false);
-					return;
+	private pluginPath(): string {
+		const vaultBasePath = (this.app.vault.adapter as any).basePath as string;
+		return path.join(vaultBasePath, '.obsidian', 'plugins', this.manifest.id);
+	}
+
+	private databasePath(): string {
+		const vaultBasePath = (this.app.vault.adapter as any).basePath as string;
+		return path.join(vaultBasePath, this.settings.DownloadDirectory);
+	}
+
+	private daemonInfo(): { port: number, token: string } | null {
+		// Written by the daemon of this vault when it starts, see daemon_main in sync.py
+		try {
+			return JSON.parse(fs.readFileSync(path.join(this.pluginPath(), 'dependencies', 'daemon.json'), 'utf8'));
+		} catch {
+			return null;
+		}
+	}
+
+	socketRequest(port: number, request: object, timeoutMs: number = 10000): Promise<any> {
+		// One JSON line each way, used for the daemon of this vault and the sync server
+		return new Promise((resolve, reject) => {
+			const socket = net.createConnection({ host: '127.0.0.1', port });
+			let buffer = '';
+			let settled = false;
+			const settle = (done: () => void) => {
+				if (!settled) {
+					settled = true;
+					done();
+				}
+			};
+			socket.setTimeout(timeoutMs);
+			socket.on('connect', () => socket.write(JSON.stringify(request) + '\n'));
+			socket.on('data', (data) => {
+				buffer += data.toString();
+				if (buffer.includes('\n')) {
+					socket.end();
+					settle(() => {
+						try {
+							resolve(JSON.parse(buffer.split('\n')[0]));
+						} catch (err) {
+							reject(err);
+						}
+					});
 				}
-				const running = stdout.toLowerCase().includes(exeName.toLowerCase());
-				resolve(running);
 			});
+			socket.on('timeout', () => {
+				socket.destroy();
+				settle(() => reject(new Error('No answer in time')));
+			});
+			socket.on('error', (err) => settle(() => reject(err)));
+			// The other side died or dropped the connection before it replied
+			socket.on('close', () => settle(() => reject(new Error('Connection closed without a reply'))));
 		});
 	}
 
+	async daemonRequest(request: object, retries: number = 0, timeoutMs: number = 10000): Promise<any> {
+		for (;;) {
+			try {
+				const daemon = this.daemonInfo();
+				if (daemon === null) {
+					throw new DaemonUnavailable('Daemon is not running');
+				}
+				const reply = await this.socketRequest(daemon.port, { ...request, plugin: this.pluginPath(), token: daemon.token }, timeoutMs);
+				if (reply.status === 'rejected') {
+					// daemon.json is stale and the port now belongs to another daemon
+					throw new DaemonUnavailable('Daemon rejected the request');
+				}
+				return reply;
+			} catch (err) {
+				// After a timeout or dropped connection the daemon did get the request, it is not sent twice
+				const refused = (err as NodeJS.ErrnoException).code === 'ECONNREFUSED';
+				if (retries <= 0 || !(err instanceof DaemonUnavailable || refused)) {
+					throw err;
+				}
+				retries--;
+				// The daemon may still be starting up
+				await new Promise((resolve) => window.setTimeout(resolve, 500));
+			}
+		}
+	}
+
+	private serverRequest(request: object, timeoutMs: number = 10000): Promise<any> {
+		// The server only trusts what this vault wrote to sync_server.json, see server_vault in sync.py
+		const serverPath = path.join(this.pluginPath(), 'dependencies', 'sync_server.json');
+		let token = '';
+		try {
+			token = JSON.parse(fs.readFileSync(serverPath, 'utf8')).token;
+		} catch {
+			// First request through the server
+		}
+		if (typeof token !== 'string' || token.length < 32) {
+			token = crypto.randomBytes(16).toString('hex');
+		}
+		fs.writeFileSync(serverPath, JSON.stringify({ token, database: this.databasePath() }), { mode: 0o600 });
+		return this.socketRequest(SERVER_PORT, { ...request, plugin: this.pluginPath(), token }, timeoutMs);
+	}
+
+	async isSyncRunning(): Promise<boolean> {
+		// sync.exe of other vaults may be running, only this vault's processes count
+		if (this.syncProcess !== null) {
+			return true;
+		}
+		try {
+			if (this.settings.SyncServer) {
+				const status = await this.serverRequest({ command: 'status' });
+				return status.busy === true;
+			}
+			const status = await this.daemonRequest({ command: 'status' });
+			return status.busy;
+		} catch {
+			return false;
+		}
+	}
+
 	async activateView() {
 		const { workspace } = this.app;
 		let leaf: WorkspaceLeaf | null = null;
@@ -99,12 +215,25 @@ export default class Bankai extends Plugin {
 		}
 
 		const ms = Math.max(1, Math.floor(minutes)) * 60 * 1000;
-		this.intervalId = window.setInterval(() => this.SyncDatabase('sync'), ms);
+		// Only the interval tick is a scheduled run, the daemon then skips subjects that are not due
+		this.intervalId = window.setInterval(() => this.SyncDatabase('sync', '', true), ms);
 		this.registerInterval(this.intervalId);
 	}
 
-	SyncDatabase(code: string, SubjectPrioritization: string = "") {
-		this.isExeRunning('sync.exe').then((running) => {
+	private syncCommand(code: string, SubjectPrioritization: string = ""): [string, string[]] {
+		const targetDir = this.databasePath();
+		const pluginPath = this.pluginPath();
+		const scriptPath = path.join(pluginPath, 'dependencies', 'dist', 'sync', 'sync.exe');
+		return [scriptPath, [targetDir, pluginPath, code, SubjectPrioritization]];
+	}
+
+	SyncDatabase(code: string, SubjectPrioritization: string = "", scheduled: boolean = false) {
+		if (code === "sync") {
+			this.syncThroughDaemon(SubjectPrioritization, scheduled);
+			return;
+		}
+
+		this.isSyncRunning().then((running) => {
 			if (running) {
 				new Notice('Already syncing');
 				return;
@@ -112,40 +241,78 @@ export default class Bankai extends Plugin {
 			
 			this.updateSyncButtons();
 			
-			const vaultBasePath = (this.app.vault.adapter as any).basePath as string;
-			const pluginId = this.manifest.id;
-			const targetDir = path.join(vaultBasePath, this.settings.DownloadDirectory);
-			const pluginPath = path.join(vaultBasePath, '.obsidian', 'plugins', pluginId);
-			const scriptPath = path.join(vaultBasePath, '.obsidian', 'plugins', pluginId, 'dependencies', 'dist', 'sync', 'sync.exe');
-			const args = [targetDir, pluginPath, code, SubjectPrioritization];
-			
-			if (code === "sync") {
-				new Notice("Started Sync");
-				this.startInterval(this.settings.DownloadInterval);
-			}
-			else {
-				new Notice("Started Setup");
-				this.startInterval(this.settings.DownloadInterval);
-			}
+			new Notice("Started Setup");
+			this.startInterval(this.settings.DownloadInterval);
 
+			const [scriptPath, args] = this.syncCommand(code, SubjectPrioritization);
 			const subprocess = spawn(scriptPath, args);
+			this.syncProcess = subprocess;
+			subprocess.on('exit', () => this.syncProcess = null);
 
 			subprocess.stdout.on('data', (data) => {
 				this.updateSyncButtons();
-				
-				if (code === "sync") {
-					new Notice("Finished Sync");
-					this.reloadTableView();
-					this.startInterval(this.settings.DownloadInterval);
-				}
-				else {
-					new Notice("Finished Setup");
-					this.startInterval(this.settings.DownloadInterval);
-				}
+				new Notice("Finished Setup");
+				this.startInterval(this.settings.DownloadInterval);
 			});
 		});
 	}
 
+	private async syncThroughDaemon(SubjectPrioritization: string, scheduled: boolean) {
+		if (this.settings.SyncServer) {
+			// The sync server of this machine runs it, started separately with: sync.exe "" <PluginPath> server ""
+			await this.runSync(() => this.serverRequest({ command: 'sync', code: 'sync', subject: SubjectPrioritization, scheduled }, SYNC_TIMEOUT_MS));
+			return;
+		}
+
+		// The daemon keeps its session between runs, it is only started when it is not running yet
+		const status = await this.daemonRequest({ command: 'status' }).catch(() => null);
+		if (status === null) {
+			if (this.syncProcess !== null) {
+				new Notice('Already syncing');
+				return;
+			}
+			const [scriptPath, args] = this.syncCommand('daemon');
+			// Nothing reads the output of the resident daemon, a pipe would fill up and block it
+			spawn(scriptPath, args, { stdio: 'ignore' });
+		} else if (status.busy) {
+			new Notice('Already syncing');
+			return;
+		}
+
+		// A whole sync can take long, the socket is idle until the daemon replies
+		await this.runSync(() => this.daemonRequest({ command: 'sync', database: this.databasePath(), subject: SubjectPrioritization, scheduled }, 20, SYNC_TIMEOUT_MS));
+	}
+
+	private async runSync(request: () => Promise<any>) {
+		new Notice("Started Sync");
+		this.startInterval(this.settings.DownloadInterval);
+		window.setTimeout(() => this.updateSyncButtons(), 1000);
+
+		try {
+			const reply = await request();
+			if (reply.status === 'busy') {
+				new Notice('Already syncing');
+				return;
+			}
+			if (reply.status === 'reauth required') {
+				new Notice('SharePoint login expired, run Setup again');
+			} else if (reply.status === 'offline') {
+				new Notice('SharePoint is not reachable');
+			} else if (reply.status === 'failed' || reply.status === 'rejected') {
+				new Notice('Sync failed');
+			} else if (reply.failed && reply.failed.length > 0) {
+				new Notice(`Finished Sync, failed: ${reply.failed.join(', ')}`);
+			} else {
+				new Notice("Finished Sync");
+			}
+			this.reloadTableView();
+		} catch {
+			new Notice('Sync failed');
+		}
+		this.updateSyncButtons();
+		this.startInterval(this.settings.DownloadInterval);
+	}
+
 	private startButtonUpdateInterval() {
 		if (this.buttonUpdateIntervalId !== null) {
 			window.clearInterval(this.buttonUpdateIntervalId);
@@ -155,7 +322,7 @@ export default class Bankai extends Plugin {
 	}
 
 	private updateSyncButtons() {
-		this.isExeRunning('sync.exe').then((running) => {
+		this.isSyncRunning().then((running) => {
 			const leaves = this.app.workspace.getLeavesOfType(VIEW_TYPE_TABLE);
 			leaves.forEach(leaf => {
 				const view = leaf.view as TableView;
@@ -194,10 +361,15 @@ export default class Bankai extends Plugin {
 	}
 
 	resetData() {
-		const vaultBasePath = (this.app.vault.adapter as any).basePath as string;
-		const pluginId = this.manifest.id;
-		const purgePath = path.join(vaultBasePath, '.obsidian', 'plugins', pluginId, 'dependencies', 'browser_data');
-		fs.rmSync(purgePath, { recursive: true, force: true });
+		// The daemon still holds the old session in memory
+		this.daemonRequest({ command: 'stop' }).catch(() => {});
+		const dependencies = path.join(this.pluginPath(), 'dependencies');
+		fs.rmSync(path.join(dependencies, 'browser_data'), { recursive: true, force: true });
+		// The cookies the REST sync signs in with, the login cookies the sync server starts its browser
+		// contexts from and the record of the last failed renewal. The sync state and database stay.
+		for (const name of ['session.json', 'login.json', 'reauth.json']) {
+			fs.rmSync(path.join(dependencies, name), { force: true });
+		}
 		new Notice('Data reset complete');
 	}
 }
@@ -275,7 +447,7 @@ class TableView extends ItemView {
 			});
 			
 			// Update button state based on current sync status
-			this.plugin.isExeRunning('sync.exe').then((running) => {
+			this.plugin.isSyncRunning().then((running) => {
 				this.updateSyncButton(running);
 			});
 			
@@ -328,14 +500,16 @@ class TableView extends ItemView {
 			for (const key in obj) {
 				if (key === '__FileData__' && typeof obj[key] === 'object' && obj[key]) {
 					for (const fileName in obj[key]) {
+						// Older databases store only the date, newer ones an object with the remote file info
+						const entry = obj[key][fileName];
 						files.push({
 							[COL_NAME]: fileName,
 							[COL_SUBJECT]: subject,
 							[COL_FOLDER]: curPath,
-							[COL_DATE]: String(obj[key][fileName]),
+							[COL_DATE]: String(typeof entry === 'object' && entry !== null ? entry.Date : entry),
 						});
 					}
-				} else if (typeof obj[key] === 'object' && obj[key] !== null) {
+				} else if (typeof obj[key] === 'object' && obj[key] !== null && !key.startsWith('__')) {
 					const newPath = curPath ? `${curPath}/${key}` : key;
 					traverse(obj[key], subject, newPath);
 				}
@@ -620,6 +794,18 @@ class BankaiSettingTab extends PluginSettingTab {
 					.onClick(() => this.plugin.SyncDatabase('setup'));
 			});
 
+		new Setting(containerEl)
+			.setName('Use sync server')
+			.setDesc('Sync through the shared sync server of this machine instead of a sync process per vault. Setup still runs here.')
+			.addToggle((toggle) =>
+				toggle
+					.setValue(this.plugin.settings.SyncServer)
+					.onChange(async (value) => {
+						this.plugin.settings.SyncServer = value;
+						await this.plugin.saveData(this.plugin.settings);
+					}),
+			);
+
 		new Setting(containerEl)
 			.setName('Reset Data')
 			.setDesc('Clear browser data and cookies. If you experience problems, try this.')